@@ -0,0 +1,103 @@
+import time
+
+# Seconds of history the transfer rates are measured over
+RATE_WINDOW = 20
+
+
+class RateMeter:
+    """
+    Transfer rate over a sliding window, the bytes are counted in slots of
+    one second and the oldest slot is dropped as time moves on.
+    """
+    def __init__(self, window: int = RATE_WINDOW):
+        self.window = max(1, window)
+        self.total = 0
+        self._slots = [0] * self.window
+        self._started = time.monotonic()
+        self._second = int(self._started)  # Second of the newest slot
+
+    def add(self, nbytes: int):
+        second = self._advance()
+        self._slots[second % self.window] += nbytes
+        self.total += nbytes
+
+    @property
+    def rate(self) -> float:
+        """
+        Bytes per second over the window, or over the time since the meter
+        was created if that is shorter
+        """
+        self._advance()
+        elapsed = min(self.window, time.monotonic() - self._started)
+        return sum(self._slots) / max(1, elapsed)
+
+    def _advance(self) -> int:
+        second = int(time.monotonic())
+        if second - self._second >= self.window:
+            self._slots = [0] * self.window
+        else:
+            for passed in range(self._second + 1, second + 1):
+                self._slots[passed % self.window] = 0
+        self._second = max(self._second, second)
+        return second
+
+
+class TokenBucket:
+    """
+    Limits a transfer to `rate` bytes per second, allowing bursts of up
+    to `burst` bytes.
+
+    Transferred bytes are taken from the bucket even when there are not
+    enough tokens, the caller is told how long to wait for the bucket to
+    get out of debt. Nothing is ever dropped, the transfer just pauses.
+    """
+    def __init__(self, rate: int, burst: int = None):
+        self.rate = rate
+        self.burst = burst or rate
+        self.tokens = self.burst
+        self._updated = time.monotonic()
+
+    def consume(self, nbytes: int) -> float:
+        """
+        Take the bytes from the bucket and return the seconds to wait
+        before transferring anything more
+        """
+        now = time.monotonic()
+        self.tokens = min(self.burst,
+                          self.tokens + (now - self._updated) * self.rate)
+        self._updated = now
+        self.tokens -= nbytes
+        if self.tokens >= 0:
+            return 0
+        return -self.tokens / self.rate
+
+
+class Traffic:
+    """
+    The rate and optional limit of one direction of traffic, either of a
+    single peer or of the whole session. Bytes transferred with a peer are
+    accounted in the session as well, through the `parent`.
+    """
+    def __init__(self, limit: int = 0, parent=None):
+        self.meter = RateMeter()
+        self.bucket = TokenBucket(limit) if limit else None
+        self.parent = parent
+
+    @property
+    def rate(self) -> float:
+        return self.meter.rate
+
+    @property
+    def total(self) -> int:
+        return self.meter.total
+
+    def transferred(self, nbytes: int) -> float:
+        """
+        Account transferred bytes and return the seconds to pause the
+        transfer to stay within the limits
+        """
+        self.meter.add(nbytes)
+        delay = self.bucket.consume(nbytes) if self.bucket else 0
+        if self.parent is not None:
+            delay = max(delay, self.parent.transferred(nbytes))
+        return delay
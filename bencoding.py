@@ -17,16 +17,48 @@ TOKEN_END = b'e'
 # Delimits string length from string data
 TOKEN_STRING_SEPARATOR = b':'
 
+# The tokens above as the integers found when indexing bytes
+_INTEGER = TOKEN_INTEGER[0]
+_LIST = TOKEN_LIST[0]
+_DICT = TOKEN_DICT[0]
+_END = TOKEN_END[0]
+_DIGIT_0 = ord('0')
+_DIGIT_9 = ord('9')
+
+# Strings at least this long are returned as views in zero-copy mode
+ZERO_COPY_THRESHOLD = 1024
+
 
 class Decoder:
     """
     Decodes a bencoded sequence of bytes.
+
+    The data is decoded in a single pass with an integer cursor and an
+    explicit stack of the lists and dicts being filled, rather than one
+    recursive call per element. With `zero_copy` enabled, strings of at
+    least `zero_copy_threshold` bytes are returned as memoryviews into the
+    data instead of copies.
+
+    The raw byte span of the top-level `info` dict is recorded in
+    `info_span`, for hashing it without encoding it again. With
+    `record_spans` the span of every dict value is recorded, see `span`.
     """
-    def __init__(self, data: bytes):
-        if not isinstance(data, bytes):
+    def __init__(self, data: bytes, zero_copy: bool = False,
+                 zero_copy_threshold: int = ZERO_COPY_THRESHOLD,
+                 record_spans: bool = False):
+        if isinstance(data, memoryview):
+            data = data.tobytes()
+        if not isinstance(data, (bytes, bytearray)):
             raise TypeError('Argument "data" must be of type bytes')
         self._data = data
+        self._view = memoryview(data)
         self._index = 0
+        self.zero_copy = zero_copy
+        self.zero_copy_threshold = zero_copy_threshold
+        # (start, end) offsets of the top-level info dict
+        self.info_span = None
+        # Path of dict keys and list positions -> (start, end) offsets
+        self.spans = {} if record_spans else None
 
     def decode(self):
         """
@@ -34,89 +66,114 @@ class Decoder:
 
         :return A python object representing the bencoded data
         """
-        c = self._peek()
-        if c is None:
-            raise EOFError('Unexpected end-of-file')
-        elif c == TOKEN_INTEGER:
-            self._consume()  # The token
-            return self._decode_int()
-        elif c == TOKEN_LIST:
-            self._consume()  # The token
-            return self._decode_list()
-        elif c == TOKEN_DICT:
-            self._consume()  # The token
-            return self._decode_dict()
-        elif c == TOKEN_END:
-            return None
-        elif c in b'01234567899':
-            return self._decode_string()
-        else:
-            raise RuntimeError('Invalid token read at {0}'.format(
-                str(self._index)))
+        data = self._data
+        find = data.find
+        length = len(data)
+        index = self._index
+        # Containers being filled, each as [container, pending dict key,
+        # offset where the pending value started]
+        stack = []
 
-    def _peek(self):
-        """
-        Return the next character from the bencoded data or None
-        """
-        if self._index + 1 >= len(self._data):
-            return None
-        return self._data[self._index:self._index + 1]
+        while True:
+            if index >= length:
+                raise EOFError('Unexpected end-of-file')
+            c = data[index]
+            start = index
 
-    def _consume(self) -> bytes:
-        """
-        Read (and therefore consume) the next character from the data
-        """
-        self._index += 1
+            if c == _INTEGER:
+                end = find(TOKEN_END, index + 1)
+                if end < 0:
+                    self._missing(TOKEN_END)
+                value = int(data[index + 1:end])
+                index = end + 1
+            elif _DIGIT_0 <= c <= _DIGIT_9:
+                separator = find(TOKEN_STRING_SEPARATOR, index)
+                if separator < 0:
+                    self._missing(TOKEN_STRING_SEPARATOR)
+                size = int(data[index:separator])
+                index = separator + 1
+                if index + size > length:
+                    raise IndexError(
+                        'Cannot read {0} bytes from current position {1}'
+                        .format(str(size), str(index)))
+                is_key = stack and type(stack[-1][0]) is dict and \
+                    stack[-1][1] is None
+                if self.zero_copy and not is_key and \
+                        size >= self.zero_copy_threshold:
+                    value = self._view[index:index + size]
+                else:
+                    value = bytes(data[index:index + size])
+                index += size
+            elif c == _LIST:
+                if stack:
+                    stack[-1][2] = start
+                stack.append([[], None, None])
+                index += 1
+                continue
+            elif c == _DICT:
+                if stack:
+                    stack[-1][2] = start
+                stack.append([{}, None, None])
+                index += 1
+                continue
+            elif c == _END:
+                if not stack:
+                    # Nothing to end, same as an empty sequence
+                    self._index = index
+                    return None
+                container, key, _ = stack.pop()
+                if key is not None:
+                    raise RuntimeError('Missing value for dict key at {0}'
+                                       .format(str(index)))
+                value = container
+                index += 1
+                if stack:
+                    start = stack[-1][2]
+            else:
+                raise RuntimeError('Invalid token read at {0}'.format(
+                    str(index)))
 
-    def _read(self, length: int) -> bytes:
-        """
-        Read the `length` number of bytes from data and return the result
-        """
-        if self._index + length > len(self._data):
-            raise IndexError('Cannot read {0} bytes from current position {1}'
-                             .format(str(length), str(self._index)))
-        res = self._data[self._index:self._index+length]
-        self._index += length
-        return res
-
-    def _read_until(self, token: bytes) -> bytes:
+            # Place the decoded value into its parent container
+            if not stack:
+                self._index = index
+                return value
+            frame = stack[-1]
+            parent = frame[0]
+            if type(parent) is list:
+                parent.append(value)
+            elif frame[1] is None:
+                if type(value) is not bytes:
+                    raise RuntimeError('Invalid dict key at {0}'.format(
+                        str(start)))
+                frame[1] = value
+            else:
+                parent[frame[1]] = value
+                if len(stack) == 1 and frame[1] == b'info':
+                    self.info_span = (start, index)
+                if self.spans is not None:
+                    self.spans[self._path(stack)] = (start, index)
+                frame[1] = None
+
+    def span(self, *path) -> tuple:
         """
-        Read from the bencoded data until the given token is found and return
-        the characters read.
+        Return the (start, end) offsets in the data of the dict value found
+        by following the given dict keys and list positions from the top
+        level, e.g. `span(b'info', b'files', 0, b'length')`. Requires the
+        decoder to be created with `record_spans`.
         """
-        try:
-            occurrence = self._data.index(token, self._index)
-            result = self._data[self._index:occurrence]
-            self._index = occurrence + 1
-            return result
-        except ValueError:
-            raise RuntimeError('Unable to find token {0}'.format(
-                str(token)))
-
-    def _decode_int(self):
-        return int(self._read_until(TOKEN_END))
-
-    def _decode_list(self):
-        res = []
-        # Recursive decode the content of the list
-        while self._data[self._index: self._index + 1] != TOKEN_END:
-            res.append(self.decode())
-        self._consume()  # The END token
-        return res
-
-    def _decode_dict(self):
-        res = OrderedDict()
-        while self._data[self._index: self._index + 1] != TOKEN_END:
-            key = self.decode()
-            obj = self.decode()
-            res[key] = obj
-        self._consume()  # The END token
-        return res
-
-    def _decode_string(self):
-        bytes_to_read = int(self._read_until(TOKEN_STRING_SEPARATOR))
-        data = self._read(bytes_to_read)
-        return data
+        if self.spans is None:
+            raise RuntimeError('Decoder created without record_spans')
+        return self.spans[tuple(path)]
+
+    @staticmethod
+    def _path(stack) -> tuple:
+        # The position a list is being filled at is its current length
+        return tuple(frame[1] if type(frame[0]) is dict else len(frame[0])
+                     for frame in stack)
+
+    @staticmethod
+    def _missing(token: bytes):
+        raise RuntimeError('Unable to find token {0}'.format(str(token)))
 
 
 class Encoder:
@@ -126,14 +183,21 @@ class Encoder:
     Supported python types is:
         - str
         - int
-        - list
+        - list (and tuple)
         - dict
-        - bytes
+        - bytes (and bytearray, memoryview)
 
-    Any other type will simply be ignored.
+    Everything is appended to a single output buffer, and dict keys are
+    written in sorted order as the bencoding specification requires. Any
+    other type raises a TypeError.
     """
+    # Buffered output is handed to the stream once it grows past this size
+    FLUSH_SIZE = 64 * 1024
+
     def __init__(self, data):
         self._data = data
+        self._buffer = None
+        self._stream = None
 
     def encode(self) -> bytes:
         """
@@ -141,51 +205,87 @@ class Encoder:
 
         :return The bencoded binary data
         """
-        return self.encode_next(self._data)
+        self._buffer = bytearray()
+        self._stream = None
+        self.encode_next(self._data)
+        return self._buffer
+
+    def encode_to(self, stream):
+        """
+        Encode a python object and write it to the given writable binary
+        stream, e.g. a file, without holding the whole result in memory.
+        """
+        self._buffer = bytearray()
+        self._stream = stream
+        self.encode_next(self._data)
+        self._flush()
+        self._stream = None
 
     def encode_next(self, data):
-        if type(data) == str:
-            return self._encode_string(data)
-        elif type(data) == int:
-            return self._encode_int(data)
-        elif type(data) == list:
-            return self._encode_list(data)
-        elif type(data) == dict or type(data) == OrderedDict:
-            return self._encode_dict(data)
-        elif type(data) == bytes:
-            return self._encode_bytes(data)
-        else:
-            return None
+        encoder = self._ENCODERS.get(type(data))
+        if encoder is None:
+            for base, candidate in self._ENCODERS.items():
+                if isinstance(data, base):
+                    encoder = candidate
+                    break
+            else:
+                raise TypeError('Cannot bencode type {0}'.format(
+                    type(data).__name__))
+        encoder(self, data)
 
-    def _encode_int(self, value):
-        return str.encode('i' + str(value) + 'e')
+    def _encode_int(self, value: int):
+        self._buffer += b'i%de' % value
 
     def _encode_string(self, value: str):
-        res = str(len(value)) + ':' + value
-        return str.encode(res)
+        self._encode_bytes(value.encode('utf-8'))
 
-    def _encode_bytes(self, value: str):
-        result = bytearray()
-        result += str.encode(str(len(value)))
-        result += b':'
-        result += value
-        return result
+    def _encode_bytes(self, value: bytes):
+        self._buffer += b'%d:' % len(value)
+        if self._stream is not None and len(value) >= self.FLUSH_SIZE:
+            # Large strings go to the stream directly, not via the buffer
+            self._flush()
+            self._stream.write(value)
+        else:
+            self._buffer += value
 
     def _encode_list(self, data):
-        result = bytearray('l', 'utf-8')
-        result += b''.join([self.encode_next(item) for item in data])
-        result += b'e'
-        return result
-
-    def _encode_dict(self, data: dict) -> bytes:
-        result = bytearray('d', 'utf-8')
-        for k, v in data.items():
-            key = self.encode_next(k)
-            value = self.encode_next(v)
-            if key and value:
-                result += key
-                result += value
-            else:
+        self._buffer += TOKEN_LIST
+        for item in data:
+            self.encode_next(item)
+        self._buffer += TOKEN_END
+        self._maybe_flush()
+
+    def _encode_dict(self, data: dict):
+        self._buffer += TOKEN_DICT
+        for key, value in sorted(
+                ((k.encode('utf-8') if type(k) is str else k, v)
+                 for k, v in data.items()),
+                key=lambda item: item[0]):
+            if not isinstance(key, (bytes, bytearray)):
                 raise RuntimeError('Bad dict')
-        result += b'e'
-        return result
+            self._encode_bytes(key)
+            self.encode_next(value)
+        self._buffer += TOKEN_END
+        self._maybe_flush()
+
+    def _maybe_flush(self):
+        if self._stream is not None and len(self._buffer) >= self.FLUSH_SIZE:
+            self._flush()
+
+    def _flush(self):
+        if self._stream is not None and self._buffer:
+            self._stream.write(self._buffer)
+            self._buffer = bytearray()
+
+    # Dispatch on the exact type, subclasses fall back to isinstance()
+    _ENCODERS = {
+        int: _encode_int,
+        str: _encode_string,
+        bytes: _encode_bytes,
+        bytearray: _encode_bytes,
+        memoryview: _encode_bytes,
+        list: _encode_list,
+        tuple: _encode_list,
+        dict: _encode_dict,
+        OrderedDict: _encode_dict,
+    }
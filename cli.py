@@ -4,23 +4,92 @@ import asyncio
 import signal
 import logging
 
-from concurrent.futures import CancelledError
+from concurrent.futures import CancelledError, ProcessPoolExecutor
 
 from torrent import Torrent
-from client import TorrentClient
+from client import TorrentClient, PRIORITY_NORMAL, PRIORITY_SKIP, \
+    UPLOAD_SLOTS
+from storage import FSYNC_POLICIES, FSYNC_NEVER
+from tracker import LISTEN_PORT
 
 
 def main():
     parser = argparse.ArgumentParser()
     parser.add_argument('torrent',help='the .torrent file')
     parser.add_argument('-v', '--verbose', action='store_true',help='display more infomation')
+    parser.add_argument('--protocol-transport', action='store_true',
+                        help='use the low-level asyncio.Protocol transport')
+    parser.add_argument('--hash-processes', type=int, default=0,
+                        help='verify pieces in a pool of N processes '
+                             'instead of threads')
+    parser.add_argument('--preallocate', action='store_true',
+                        help='allocate the whole output files up front')
+    parser.add_argument('--fsync', choices=FSYNC_POLICIES,
+                        default=FSYNC_NEVER,
+                        help='when written data is flushed to disk')
+    parser.add_argument('--max-staging-memory', type=int, default=128,
+                        help='memory in MiB used for assembling pieces')
+    parser.add_argument('--recheck', action='store_true',
+                        help='verify existing data instead of trusting '
+                             'the resume file')
+    parser.add_argument('--files',
+                        type=lambda s: [int(i) for i in s.split(',')],
+                        help='comma separated indices of the files to '
+                             'download, all others are skipped')
+    parser.add_argument('--streaming', action='store_true',
+                        help='download the pieces in order, for reading '
+                             'while downloading')
+    parser.add_argument('--seed', action='store_true',
+                        help='keep uploading once the download is complete')
+    parser.add_argument('--sendfile', action='store_true',
+                        help='upload blocks straight from the files with '
+                             'sendfile()')
+    parser.add_argument('--upload-slots', type=int, default=UPLOAD_SLOTS,
+                        help='number of peers uploaded to at the same time')
+    parser.add_argument('--download-limit', type=int, default=0,
+                        help='download rate limit in KiB/s, 0 for none')
+    parser.add_argument('--upload-limit', type=int, default=0,
+                        help='upload rate limit in KiB/s, 0 for none')
+    parser.add_argument('--peer-download-limit', type=int, default=0,
+                        help='download rate limit of every peer in KiB/s')
+    parser.add_argument('--peer-upload-limit', type=int, default=0,
+                        help='upload rate limit of every peer in KiB/s')
+    parser.add_argument('--port', type=int, default=LISTEN_PORT,
+                        help='port to accept connections from peers on')
     args = parser.parse_args()
     print(args)
     if args.verbose:
         logging.basicConfig(level=logging.INFO)
 
+    torrent = Torrent(args.torrent)
+    file_priorities = None
+    if args.files is not None:
+        file_priorities = [
+            PRIORITY_NORMAL if index in args.files else PRIORITY_SKIP
+            for index in range(len(torrent.files))]
+
     loop = asyncio.get_event_loop()
-    client = TorrentClient(Torrent(args.torrent))
+    executor = None
+    if args.hash_processes:
+        executor = ProcessPoolExecutor(max_workers=args.hash_processes)
+    client = TorrentClient(torrent,
+                           use_protocol=args.protocol_transport,
+                           verify_executor=executor,
+                           streaming_hash=executor is None,
+                           preallocate=args.preallocate,
+                           fsync=args.fsync,
+                           max_staging_memory=args.max_staging_memory * 2**20,
+                           recheck=args.recheck,
+                           file_priorities=file_priorities,
+                           streaming=args.streaming,
+                           seed=args.seed,
+                           use_sendfile=args.sendfile,
+                           upload_slots=args.upload_slots,
+                           download_limit=args.download_limit * 1024,
+                           upload_limit=args.upload_limit * 1024,
+                           peer_download_limit=args.peer_download_limit * 1024,
+                           peer_upload_limit=args.peer_upload_limit * 1024,
+                           port=args.port)
     task = loop.create_task(client.start())
 
     def signal_handler(*_):
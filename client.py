@@ -1,52 +1,173 @@
 import asyncio
+import functools
+import heapq
+import itertools
 import logging
 import math
 import os
+import random
+import socket
+import threading
 import time
+from array import array
 from asyncio import Queue
-from collections import namedtuple, defaultdict
+from collections import namedtuple, deque, OrderedDict
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
 from hashlib import sha1
 
-from protocol import PeerConnection, REQUEST_SIZE
-from tracker import Tracker
+import bitstring
+
+from bandwidth import Traffic
+from protocol import PeerConnection, ProtocolError, REQUEST_SIZE
+from storage import BufferPool, DiskWriter, FileStorage, FSYNC_NEVER, \
+    ReadCache, hash_pieces, read_resume, write_resume
+from tracker import LISTEN_PORT, Tracker
 
 # 最大peer连接数
 MAX_PEER_CONNECTIONS = 40
 
+# Default number of complete pieces being hashed at the same time
+MAX_PENDING_VERIFICATIONS = 8
+
+# Default cap on the memory used for assembling pieces
+MAX_STAGING_MEMORY = 128 * 2**20
+
+# Seconds between saving the fast-resume state while downloading
+RESUME_SAVE_INTERVAL = 60
+
+# Amount of data hashed by one job of a recheck
+RECHECK_BATCH_SIZE = 64 * 2**20
+
+# Seconds a block request may take before it is given to another peer,
+# until the round-trip time of the peer is known
+INITIAL_REQUEST_TIMEOUT = 30
+
+# Lower bound of the request timeout derived from the round-trip time
+MIN_REQUEST_TIMEOUT = 2
+
+# Seconds without any block from a peer with requests outstanding after
+# which it is considered to be snubbing us
+SNUB_TIMEOUT = 30
+
+# Number of peers each remaining block is requested from in endgame mode
+ENDGAME_COPIES = 3
+
+# Amount of data after the read cursor downloaded in order when streaming
+STREAMING_WINDOW = 16 * 2**20
+
+# Default number of peers we upload to at the same time, one of them is
+# the optimistic unchoke
+UPLOAD_SLOTS = 4
+
+# Seconds between two rounds of the choker
+CHOKE_INTERVAL = 10
+
+# Seconds before the optimistic unchoke moves to another peer
+OPTIMISTIC_UNCHOKE_INTERVAL = 30
+
+# Priorities of files and pieces, skipped ones are never downloaded
+PRIORITY_SKIP = 0
+PRIORITY_LOW = 1
+PRIORITY_NORMAL = 2
+PRIORITY_HIGH = 3
+
 
 class TorrentClient:
-    def __init__(self, torrent):
-        self.tracker = Tracker(torrent)
+    def __init__(self, torrent, use_protocol: bool = False,
+                 verify_executor=None, streaming_hash: bool = True,
+                 preallocate: bool = False, fsync: str = FSYNC_NEVER,
+                 max_staging_memory: int = MAX_STAGING_MEMORY,
+                 recheck: bool = False, file_priorities: list = None,
+                 streaming: bool = False, seed: bool = False,
+                 use_sendfile: bool = False,
+                 upload_slots: int = UPLOAD_SLOTS, download_limit: int = 0,
+                 upload_limit: int = 0, peer_download_limit: int = 0,
+                 peer_upload_limit: int = 0, port: int = LISTEN_PORT):
+        self.tracker = Tracker(torrent, port=port)
         self.available_peers = Queue()
         self.peers = []
-        self.piece_manager = PieceManager(torrent)
+        self.piece_manager = PieceManager(
+            torrent, verify_executor=verify_executor,
+            streaming_hash=streaming_hash, preallocate=preallocate,
+            fsync=fsync, max_staging_memory=max_staging_memory,
+            on_resume_cb=self._on_resume, on_cancel_cb=self._on_cancel,
+            on_have_cb=self._on_have, recheck=recheck,
+            file_priorities=file_priorities, streaming=streaming)
         self.abort = False
+        # Use the low-level asyncio.Protocol transport for peers
+        self.use_protocol = use_protocol
+        # Keep uploading to other peers once the download is complete
+        self.seed = seed
+        # Send uploaded blocks straight from the files with sendfile()
+        self.use_sendfile = use_sendfile
+        self.choker = Choker(upload_slots)
+        # Rates and limits in bytes per second, a limit of 0 is unlimited
+        self.download = Traffic(download_limit)
+        self.upload = Traffic(upload_limit)
+        self.peer_download_limit = peer_download_limit
+        self.peer_upload_limit = peer_upload_limit
+        # Port incoming connections are accepted on, 0 for any free one
+        self.port = port
+        self.server = None
+        self.listener = None
 
     async def start(self):
+        if self.piece_manager.needs_recheck:
+            await self.piece_manager.recheck()
+
         self.peers = [PeerConnection(self.available_peers,
                                      self.tracker.torrent.info_hash,
                                      self.tracker.peer_id,
                                      self.piece_manager,
-                                     self._on_block_retrieved)
+                                     self._on_block_retrieved,
+                                     use_protocol=self.use_protocol,
+                                     use_sendfile=self.use_sendfile,
+                                     on_interested_cb=self._on_interested,
+                                     session_download=self.download,
+                                     session_upload=self.upload,
+                                     download_limit=self.peer_download_limit,
+                                     upload_limit=self.peer_upload_limit,
+                                     is_connected_cb=self._is_connected)
                       for _ in range(MAX_PEER_CONNECTIONS)]
+        self._listen()
 
         previous = None
         interval = 30*60
+        saved = time.time()
+        choked = 0
 
+        seeding = False
         while True:
-            if self.piece_manager.complete:
+            if self.piece_manager.complete and not seeding:
                 logging.info('Torrent fully downloaded!')
-                break
+                if not self.seed:
+                    break
+                seeding = True
+                self.piece_manager.save_resume()
             if self.abort:
                 logging.info('Aborting download...')
                 break
 
+            if self.piece_manager.expire_requests():
+                # Peers that stopped asking may pick up the given up blocks
+                self._on_resume()
             current = time.time()
+            if choked + CHOKE_INTERVAL <= current:
+                self.choker.run(self.peers, seeding)
+                choked = current
+                logging.info('Downloading at {down:.1f} KiB/s, uploading '
+                             'at {up:.1f} KiB/s'.format(
+                                down=self.download.rate / 1024,
+                                up=self.upload.rate / 1024))
+            if saved + RESUME_SAVE_INTERVAL < current:
+                self.piece_manager.save_resume()
+                saved = current
             if (not previous) or (previous + interval < current):  # 该联系tracker啦
                 response = await self.tracker.connect(
                     first=previous if previous else False,
                     uploaded=self.piece_manager.bytes_uploaded,
-                    downloaded=self.piece_manager.bytes_downloaded)
+                    downloaded=self.piece_manager.bytes_downloaded,
+                    left=self.piece_manager.bytes_left)
 
                 if response:
                     previous = current
@@ -67,236 +188,1509 @@ class TorrentClient:
         self.abort = True
         for peer in self.peers:
             peer.stop()
+        if self.listener:
+            self.listener.cancel()
+            self.listener = None
+        if self.server:
+            self.server.close()
+            self.server = None
         self.piece_manager.close()
         self.tracker.close()
 
+    async def read(self, offset: int, length: int) -> bytes:
+        """
+        Return `length` bytes of the torrent data starting at `offset`,
+        waiting until the pieces holding them are downloaded, verified and
+        written. This can be called while the download is running.
+        """
+        return await self.piece_manager.read(offset, length)
+
+    def _listen(self):
+        try:
+            self.server = socket.create_server(('', self.port))
+        except OSError as e:
+            logging.warning('Unable to listen on port {port}: {error}'.format(
+                port=self.port, error=e))
+            return
+        self.server.setblocking(False)
+        # Announce the port actually bound, in case any free one was asked
+        self.tracker.port = self.server.getsockname()[1]
+        logging.info('Listening for peers on port {port}'.format(
+            port=self.tracker.port))
+        self.listener = asyncio.ensure_future(self._accept())
+
+    async def _accept(self):
+        """
+        Hand incoming connections to idle PeerConnections. These are the
+        same workers connecting to the peers from the tracker, so both
+        share the MAX_PEER_CONNECTIONS budget.
+        """
+        loop = asyncio.get_event_loop()
+        while True:
+            try:
+                sock, address = await loop.sock_accept(self.server)
+            except OSError as e:
+                logging.warning('Unable to accept a connection: {error}'
+                                .format(error=e))
+                await asyncio.sleep(1)
+                continue
+            peer = next((peer for peer in self.peers if peer.idle), None)
+            if peer is None:
+                logging.info('Refusing connection from {ip}, too many '
+                             'peers'.format(ip=address[0]))
+                sock.close()
+                continue
+            sock.setblocking(False)
+            peer.accept(sock, address)
+
+    def _on_resume(self):
+        for peer in self.peers:
+            peer.resume_requests()
+
+    def _on_have(self, index: int):
+        for peer in self.peers:
+            peer.send_have(index)
+
+    def _is_connected(self, remote_id) -> bool:
+        return any(peer.remote_id == remote_id for peer in self.peers)
+
+    def _on_interested(self, peer):
+        self.choker.interested(peer, self.peers)
+
+    def _on_cancel(self, peer_id, block):
+        for peer in self.peers:
+            if peer.remote_id == peer_id:
+                peer.cancel_request(block.piece, block.offset, block.length)
+
     def _on_block_retrieved(self, peer_id, piece_index, block_offset, data):
         self.piece_manager.block_received(
             peer_id=peer_id, piece_index=piece_index,
             block_offset=block_offset, data=data)
 
 
+class Choker:
+    """
+    Decides which peers we upload to, by tit-for-tat.
+
+    Every round the interested peers sending us data at the highest rate,
+    or taking it from us at the highest rate once we are seeding, get the
+    regular upload slots and all others are choked. The last slot is an
+    optimistic unchoke given to a random choked peer, so new peers get the
+    chance to show what they can give us. It moves to another peer every
+    OPTIMISTIC_UNCHOKE_INTERVAL seconds.
+    """
+    def __init__(self, slots: int = UPLOAD_SLOTS):
+        self.slots = max(1, slots)
+        self.optimistic = None
+        self._optimistic_since = 0
+
+    def run(self, peers: list, seeding: bool = False):
+        now = time.time()
+        rates = {peer: peer.upload.rate if seeding else peer.download.rate
+                 for peer in peers if peer.connected}
+
+        interested = [peer for peer in rates if peer.peer_interested]
+        interested.sort(key=lambda peer: rates[peer], reverse=True)
+        unchoked = set(interested[:self.slots - 1])
+
+        if self.optimistic not in rates or \
+                not self.optimistic.peer_interested or \
+                self.optimistic in unchoked or \
+                self._optimistic_since + OPTIMISTIC_UNCHOKE_INTERVAL <= now:
+            choked = [peer for peer in interested
+                      if peer not in unchoked and peer is not self.optimistic]
+            if choked:
+                self.optimistic = random.choice(choked)
+                self._optimistic_since = now
+            elif self.optimistic in unchoked or \
+                    self.optimistic not in interested:
+                self.optimistic = None
+        if self.optimistic is not None:
+            unchoked.add(self.optimistic)
+
+        logging.debug('Unchoking {count} of {total} peers'.format(
+            count=len(unchoked), total=len(rates)))
+        for peer in rates:
+            if peer in unchoked:
+                peer.unchoke()
+            else:
+                peer.choke()
+
+    def interested(self, peer, peers: list):
+        """
+        Unchoke a peer that became interested right away if a slot is free,
+        instead of making it wait for the next round
+        """
+        unchoked = sum(1 for other in peers
+                       if other.connected and not other.choking)
+        if peer.choking and unchoked < self.slots:
+            peer.unchoke()
+
+
 class Block:
+    """
+    A block of a piece as handed out to be requested. The status of every
+    block in the torrent lives in the state array of the PieceManager,
+    these are only created on demand.
+    """
     Missing = 0
     Pending = 1
     Retrieved = 2
 
-    def __init__(self, piece: int, offset: int, length: int):
+    __slots__ = ('piece', 'offset', 'length', 'status')
+
+    def __init__(self, piece: int, offset: int, length: int,
+                 status: int = Missing):
         self.piece = piece
         self.offset = offset
         self.length = length
-        self.status = Block.Missing
-        self.data = None
+        self.status = status
 
 
 class Piece:
-    def __init__(self, index: int, blocks: [], hash_value):
+    """
+    A piece that is being downloaded. The status of its blocks is kept in
+    the state array shared by all pieces, from position `first` onwards.
+    """
+    Missing = 0
+    Ongoing = 1
+    Have = 2
+    # Verified, but only the parts in files not skipped were written
+    HavePart = 3
+
+    __slots__ = ('index', 'hash', 'length', 'num_blocks', 'buffer',
+                 '_states', '_first', '_missing', '_retrieved', '_hasher',
+                 '_hashed', '_hashing')
+
+    def __init__(self, index: int, length: int, hash_value,
+                 states: bytearray, first: int):
         self.index = index
-        self.blocks = blocks
         self.hash = hash_value
+        self.length = length
+        # Only the last piece (and its last block) can be shorter
+        self.num_blocks = math.ceil(length / REQUEST_SIZE)
+        # Staging buffer the blocks are written into at their offset, only
+        # assigned while the piece is being downloaded
+        self.buffer = None
+        self._states = states
+        self._first = first
+        self.reset()
 
     def reset(self):
-        for block in self.blocks:
-            block.status = Block.Missing
+        first = self._first
+        self._states[first:first + self.num_blocks] = bytes(self.num_blocks)
+        # Positions of blocks not yet requested, lowest offset on top
+        self._missing = list(reversed(range(self.num_blocks)))
+        self._retrieved = 0
+        # Running hash over the leading blocks received so far
+        self._hasher = sha1()
+        self._hashed = 0
+        # Blocks are being fed to the hasher, see start_hashing()
+        self._hashing = False
+
+    @property
+    def blocks(self) -> [Block]:
+        return [self.block(position) for position in range(self.num_blocks)]
+
+    def block(self, position: int) -> Block:
+        offset = position * REQUEST_SIZE
+        return Block(self.index, offset,
+                     min(REQUEST_SIZE, self.length - offset),
+                     self._states[self._first + position])
 
     def next_request(self) -> Block:
-        missing = [b for b in self.blocks if b.status is Block.Missing]
-        if missing:
-            missing[0].status = Block.Pending
-            return missing[0]
+        states = self._states
+        while self._missing:
+            position = self._missing.pop()
+            # Blocks can be retrieved without being requested first
+            if states[self._first + position] == Block.Missing:
+                states[self._first + position] = Block.Pending
+                return self.block(position)
         return None
 
+    def has_missing(self) -> bool:
+        return len(self._missing) > 0
+
+    def reserve(self, position: int):
+        """
+        Keep a missing block from being requested, its data is loaded from
+        the disk instead
+        """
+        if self._states[self._first + position] == Block.Missing:
+            self._states[self._first + position] = Block.Pending
+            self._missing.remove(position)
+
+    def release(self, offset: int):
+        """
+        Make a requested block available to be requested again
+        """
+        position = offset // REQUEST_SIZE
+        if self._states[self._first + position] == Block.Pending:
+            self._states[self._first + position] = Block.Missing
+            self._missing.append(position)
+
     def block_received(self, offset: int, data: bytes):
-        matches = [b for b in self.blocks if b.offset == offset]
-        block = matches[0] if matches else None
-        if block:
-            block.status = Block.Retrieved
-            block.data = data
-        else:
+        position, remainder = divmod(offset, REQUEST_SIZE)
+        if remainder or not 0 <= position < self.num_blocks:
             logging.warning('Trying to complete a non-existing block {offset}'
                             .format(offset=offset))
+            return
+        if self._states[self._first + position] == Block.Retrieved:
+            # Keep the first copy, it may already be hashed
+            return
+        length = min(REQUEST_SIZE, self.length - offset)
+        if len(data) != length:
+            logging.warning('Discarding block {offset} of wrong length'
+                            .format(offset=offset))
+            return
+        self.buffer[offset:offset + length] = data
+        self._retrieved += 1
+        self._states[self._first + position] = Block.Retrieved
 
     def is_complete(self) -> bool:
-        blocks = [b for b in self.blocks if b.status is not Block.Retrieved]
-        return len(blocks) is 0
+        return self._retrieved == self.num_blocks
+
+    def start_hashing(self):
+        """
+        Claim the blocks that extend the contiguous prefix received so far
+        for the running hash. Returns the hasher, a view of the data to feed
+        it and the position hashed up to, to be passed to `hashed` once
+        done. None if there is nothing to hash or hashing is underway.
+        """
+        if self._hashing:
+            return None
+        states = self._states
+        end = self._hashed
+        while end < self.num_blocks and \
+                states[self._first + end] == Block.Retrieved:
+            end += 1
+        if end == self._hashed:
+            return None
+        self._hashing = True
+        data = memoryview(self.buffer)[self._hashed * REQUEST_SIZE:
+                                       min(end * REQUEST_SIZE, self.length)]
+        return self._hasher, data, end
+
+    def hashed(self, hasher, end: int) -> bool:
+        """
+        Record the claimed blocks as hashed. False if the piece was reset
+        while hashing, the result is of no use then.
+        """
+        if hasher is not self._hasher:
+            return False
+        self._hashed = end
+        self._hashing = False
+        return True
+
+    def update_hash(self):
+        """
+        Feed the running hash with the blocks that extend the contiguous
+        prefix received so far, right away. Blocks arriving out of order
+        are held until the blocks before them are in.
+        """
+        job = self.start_hashing()
+        if job:
+            hasher, data, end = job
+            with data:
+                hasher.update(data)
+            self.hashed(hasher, end)
+
+    def is_hashed(self) -> bool:
+        return self._hashed == self.num_blocks
 
     def is_hash_matching(self):
-        piece_hash = sha1(self.data).digest()
-        return self.hash == piece_hash
+        if self._hashed == self.num_blocks:
+            return self.hash == self._hasher.digest()
+        return self.hash == piece_hash(self.buffer, self.length)
 
     @property
     def data(self):
-        retrieved = sorted(self.blocks, key=lambda b: b.offset)
-        blocks_data = [b.data for b in retrieved]
-        return b''.join(blocks_data)
+        return memoryview(self.buffer)[:self.length]
+
+
+class PieceAvailability:
+    """
+    Counts how many of the connected peers have each piece and keeps the
+    pieces we still need bucketed by priority and that count, so the
+    rarest piece of the highest priority a peer can give us is found
+    without looking at every piece or peer.
+    """
+    def __init__(self, total_pieces: int, track_all: bool = False):
+        self.total_pieces = total_pieces
+        self.counts = array('I', [0]) * total_pieces
+        self.priorities = bytearray([PRIORITY_NORMAL]) * total_pieces
+        # Bucket n of a priority holds the tracked pieces available from n
+        # peers, and the position of a tracked piece within its bucket is
+        # -1 if not tracked
+        self._buckets = [[array('I')] for _ in range(PRIORITY_HIGH + 1)]
+        if track_all:
+            self._buckets[PRIORITY_NORMAL] = [array('I', range(total_pieces))]
+            self._positions = array('i', range(total_pieces))
+        else:
+            self._positions = array('i', [-1]) * total_pieces
+        self._lowest = [0] * (PRIORITY_HIGH + 1)
+
+    def track(self, index: int):
+        if self._positions[index] < 0:
+            self._insert(index, self.counts[index])
+
+    def untrack(self, index: int):
+        if self._positions[index] >= 0:
+            self._delete(index, self.counts[index])
+
+    def set_priority(self, index: int, priority: int):
+        tracked = self._positions[index] >= 0
+        if tracked:
+            self._delete(index, self.counts[index])
+        self.priorities[index] = priority
+        if tracked:
+            self._insert(index, self.counts[index])
+
+    def add_bitfield(self, bitfield):
+        for index in self._indices(bitfield):
+            self.increment(index)
+
+    def remove_bitfield(self, bitfield):
+        for index in self._indices(bitfield):
+            self.decrement(index)
 
-# The type used for keeping track of pending request that can be re-issued
-PendingRequest = namedtuple('PendingRequest', ['block', 'added'])
+    def increment(self, index: int):
+        self._move(index, 1)
+
+    def decrement(self, index: int):
+        if self.counts[index] > 0:
+            self._move(index, -1)
+
+    def rarest(self, bitfield):
+        """
+        Return the index of a tracked piece the given peer has that is of
+        the highest priority and available from as few peers as possible,
+        ties broken randomly, or None if the peer has none of the tracked
+        pieces that are not skipped.
+        """
+        for priority in range(PRIORITY_HIGH, PRIORITY_SKIP, -1):
+            buckets = self._buckets[priority]
+            # Pieces no peer has (bucket 0) can never be requested
+            count = max(self._lowest[priority], 1)
+            while count < len(buckets) and not buckets[count]:
+                count += 1
+            self._lowest[priority] = count
+
+            while count < len(buckets):
+                bucket = buckets[count]
+                if bucket:
+                    size = len(bucket)
+                    start = random.randrange(size)
+                    for i in range(size):
+                        index = bucket[(start + i) % size]
+                        if bitfield[index]:
+                            return index
+                count += 1
+        return None
+
+    def _indices(self, bitfield):
+        for index in bitfield.findall('0b1'):
+            if index >= self.total_pieces:
+                break
+            yield index
+
+    def _move(self, index: int, delta: int):
+        tracked = self._positions[index] >= 0
+        if tracked:
+            self._delete(index, self.counts[index])
+        self.counts[index] += delta
+        if tracked:
+            self._insert(index, self.counts[index])
+
+    def _insert(self, index: int, count: int):
+        priority = self.priorities[index]
+        buckets = self._buckets[priority]
+        while len(buckets) <= count:
+            buckets.append(array('I'))
+        bucket = buckets[count]
+        self._positions[index] = len(bucket)
+        bucket.append(index)
+        if count < self._lowest[priority]:
+            self._lowest[priority] = count
+
+    def _delete(self, index: int, count: int):
+        # Swap with the last piece in the bucket to remove in constant time
+        bucket = self._buckets[self.priorities[index]][count]
+        position = self._positions[index]
+        last = bucket.pop()
+        if last != index:
+            bucket[position] = last
+            self._positions[last] = position
+        self._positions[index] = -1
+
+
+def piece_hash(data: bytearray, length: int) -> bytes:
+    # Module level so it can be shipped to a process pool as well
+    with memoryview(data) as view:
+        return sha1(view[:length]).digest()
+
+
+# The type used for keeping track of pending requests, `peers` maps the id
+# of every peer the block is requested from to the time it was requested
+PendingRequest = namedtuple('PendingRequest', ['block', 'peers'])
+
+
+class RequestTimer:
+    """
+    Round-trip time estimate of the block requests sent to a peer, from
+    which the time a request may take is derived the way TCP derives its
+    retransmission timeout (RFC 6298).
+    """
+    __slots__ = ('srtt', 'rttvar', 'backoff', 'pending', 'last_active',
+                 'snubbed')
+
+    def __init__(self):
+        self.srtt = None
+        self.rttvar = None
+        self.backoff = 1
+        # Keys of the blocks requested from the peer and not yet received
+        self.pending = set()
+        # Last time the peer sent a block or got its first request
+        self.last_active = time.monotonic()
+        self.snubbed = False
+
+    def timeout(self, maximum: float) -> float:
+        if self.srtt is None:
+            timeout = INITIAL_REQUEST_TIMEOUT
+        else:
+            timeout = max(MIN_REQUEST_TIMEOUT, self.srtt + 4 * self.rttvar)
+        return min(maximum, timeout * self.backoff)
+
+    def sample(self, rtt: float):
+        if self.srtt is None:
+            self.srtt = rtt
+            self.rttvar = rtt / 2
+        else:
+            self.rttvar = 0.75 * self.rttvar + 0.25 * abs(self.srtt - rtt)
+            self.srtt = 0.875 * self.srtt + 0.125 * rtt
+        self.backoff = 1
 
 
 class PieceManager:
 
-    def __init__(self, torrent):
+    def __init__(self, torrent, verify_executor=None,
+                 max_verifications: int = MAX_PENDING_VERIFICATIONS,
+                 streaming_hash: bool = True, preallocate: bool = False,
+                 fsync: str = FSYNC_NEVER,
+                 max_staging_memory: int = MAX_STAGING_MEMORY,
+                 on_resume_cb=None, on_cancel_cb=None, on_have_cb=None,
+                 recheck: bool = False, file_priorities: list = None,
+                 streaming: bool = False):
         self.torrent = torrent
         self.peers = {}
-        self.pending_blocks = [] #等待
-        self.missing_pieces = []
-        self.ongoing_pieces = []
-        self.have_pieces = []
-        self.max_pending_time = 300 * 1000  # 5 minutes
-        self.missing_pieces = self._initiate_pieces()
+        # (piece index, block offset) -> PendingRequest
+        self.pending_blocks = {} #等待
+        # peer id -> RequestTimer
+        self.timers = {}
+        # Heap of (deadline, sequence, key, peer id, time requested) of the
+        # pending requests. Entries of requests answered in the meantime
+        # are only dropped once they come up.
+        self._deadlines = []
+        self._sequence = 0
         self.total_pieces = len(torrent.pieces)
-        self.fd = os.open(self.torrent.output_file,  os.O_RDWR | os.O_CREAT)
-
-    def _initiate_pieces(self) -> [Piece]:
-        torrent = self.torrent
-        pieces = []
-        total_pieces = len(torrent.pieces)
-        std_piece_blocks = math.ceil(torrent.piece_length / REQUEST_SIZE) # （标准）每个piece中block的个数
-
-        for index, hash_value in enumerate(torrent.pieces):
-            if index < (total_pieces - 1):
-                blocks = [Block(index, offset * REQUEST_SIZE, REQUEST_SIZE)
-                          for offset in range(std_piece_blocks)]
-            else:
-                last_length = torrent.total_size % torrent.piece_length
-                num_blocks = math.ceil(last_length / REQUEST_SIZE)
-                blocks = [Block(index, offset * REQUEST_SIZE, REQUEST_SIZE)
-                          for offset in range(num_blocks)]
-
-                if last_length % REQUEST_SIZE > 0:
-                    last_block = blocks[-1]
-                    last_block.length = last_length % REQUEST_SIZE
-                    blocks[-1] = last_block
-            pieces.append(Piece(index, blocks, hash_value))
-        return pieces
+        # The state of every piece and every block in the torrent, a Piece
+        # object only exists while the piece is ongoing
+        self.piece_states = bytearray(self.total_pieces)
+        self.blocks_per_piece = math.ceil(torrent.piece_length / REQUEST_SIZE)
+        self.block_states = bytearray(
+            self.total_pieces * self.blocks_per_piece)
+        self.have_count = 0
+        # Pieces verified and written, kept up to date for the resume file
+        # and the BitField message
+        self.have_bits = bitstring.BitArray(self.total_pieces)
+        # Resume state is written off the event loop, the newest state
+        # written wins when saves overlap
+        self._resume_lock = threading.Lock()
+        self._resume_version = 0
+        self._resume_written = 0
+        self._saving = None
+        # piece index -> Piece
+        self.ongoing_pieces = OrderedDict()
+        # Ongoing pieces that still have blocks left to request
+        self.partial_pieces = OrderedDict()
+        # piece index -> positions of the blocks on disk, of pieces spilled
+        # out of the staging memory, and of those being loaded back
+        self.spilled = {}
+        self._restoring = {}
+        self.max_pending_time = 300 * 1000  # Longest request timeout
+        # All pieces are missing until the resume state says otherwise
+        self.availability = PieceAvailability(self.total_pieces,
+                                              track_all=True)
+        self.piece_priorities = self.availability.priorities
+        # (path, length) of the files the pieces are stored in
+        self.files = [(file.name, file.length) for file in torrent.files]
+        self.storage = FileStorage(self.files)
+        self.file_priorities = bytearray([PRIORITY_NORMAL]) * len(self.files)
+        # When streaming the pieces right after the read cursor (a piece
+        # index) are downloaded first, in order
+        self.streaming = streaming
+        self.read_cursor = 0
+        self.streaming_window = max(
+            1, STREAMING_WINDOW // torrent.piece_length)
+        # piece index -> futures of the reads waiting for the piece, the
+        # longest waiting first
+        self._waiters = OrderedDict()
+        # Pieces and bytes not skipped that are still to be downloaded
+        self.wanted_left = self.total_pieces
+        self.bytes_left = torrent.total_size
+        for index, priority in enumerate(file_priorities or []):
+            self.set_file_priority(index, priority)
+        # Checked before creating any missing files
+        has_data = self.storage.has_data()
+        self.storage.create(preallocate, skip=[
+            index for index, priority in enumerate(self.file_priorities)
+            if priority == PRIORITY_SKIP])
+        self.writer = DiskWriter(self.storage, fsync=fsync)
+        # Verified pieces queued for writing, piece index -> Piece
+        self.writing = {}
+        # Every ongoing piece is assembled in one of these buffers
+        self.buffers = BufferPool(torrent.piece_length, max_staging_memory)
+        # Called once new pieces can be started again after a request was
+        # turned down because of congestion
+        self.on_resume_cb = on_resume_cb
+        self._stalled = False
+        # Called with a peer id and a block requested from that peer, once
+        # the block was received from another peer
+        self.on_cancel_cb = on_cancel_cb
+        self._endgame = False
+        # Called with the index of every piece written while running
+        self.on_have_cb = on_have_cb
+        # Blocks requested by other peers are read through this
+        self.read_cache = ReadCache(self.storage, torrent.piece_length)
+        self.uploaded = 0
+        # Complete pieces are hashed off the event loop. hashlib releases
+        # the GIL for large buffers so a thread pool scales with the cores.
+        self._own_executor = verify_executor is None
+        self.verify_executor = verify_executor or ThreadPoolExecutor(
+            max_workers=os.cpu_count())
+        self.max_verifications = max_verifications
+        self.verifying = {}  # piece index -> Piece, submitted for hashing
+        self.verify_backlog = deque()  # Pieces waiting for a free slot
+        # Hash blocks as they arrive in order, so a piece is verified right
+        # after its last block. The running hash is updated on the verify
+        # executor, which has to share it, so it can not be a process pool.
+        self.streaming_hash = streaming_hash and \
+            not isinstance(self.verify_executor, ProcessPoolExecutor)
+        self._closed = False
+
+        # Pick up where a previous run stopped. Without resume state all
+        # data already in the output file has to be verified first.
+        self.resume_file = self.torrent.output_file + '.resume'
+        state = None
+        if not recheck:
+            state = read_resume(self.resume_file, torrent.info_hash)
+        if state:
+            self._load_resume(state)
+        self.needs_recheck = not state and has_data
+
+    def _new_piece(self, index: int) -> Piece:
+        return Piece(index, self.torrent.piece_size(index),
+                     self.torrent.pieces[index], self.block_states,
+                     index * self.blocks_per_piece)
 
     def close(self):
-        if self.fd:
-            os.close(self.fd)
+        if self._closed:
+            return
+        self._closed = True
+        # Blocks of unfinished pieces are kept in the output file as well,
+        # so the resume state can point at them.
+        for piece in self.ongoing_pieces.values():
+            pos = piece.index * self.torrent.piece_length
+            for block in piece.blocks:
+                if block.status != Block.Retrieved:
+                    continue
+                for offset, length in self._wanted_ranges(
+                        pos + block.offset, block.length):
+                    self.writer.write(offset, [
+                        piece.data[offset - pos:offset - pos + length]])
+        self.writer.close()
+        if self._own_executor:
+            self.verify_executor.shutdown(wait=False)
+        self.save_resume(partial=True)
+        for waiters in self._waiters.values():
+            for waiter in waiters:
+                waiter.cancel()
+
+    def save_resume(self, partial: bool = False):
+        """
+        Store which pieces are verified and on disk in the resume file.
+        With `partial` the received blocks of unfinished pieces are
+        included, which is only valid once they have been written.
+        """
+        # Pieces only partly written are downloaded again after a restart
+        have = self.have_bits
+        if self._closed and self.writing:
+            # Queued writes are complete once the writer is closed
+            have = have.copy()
+            have.set(True, list(self.writing))
+        partial_pieces = []
+        if partial:
+            on_disk = {}
+            for index, positions in itertools.chain(
+                    self.spilled.items(), self._restoring.items()):
+                on_disk.setdefault(index, set()).update(positions)
+            for piece in self.ongoing_pieces.values():
+                pos = piece.index * self.torrent.piece_length
+                on_disk.setdefault(piece.index, set()).update(
+                    i for i, b in enumerate(piece.blocks)
+                    if b.status == Block.Retrieved and
+                    self._is_wanted(pos + b.offset, b.length))
+            for index, positions in on_disk.items():
+                if positions:
+                    blocks = bitstring.BitArray(math.ceil(
+                        self.torrent.piece_size(index) / REQUEST_SIZE))
+                    blocks.set(True, list(positions))
+                    partial_pieces.append({b'blocks': blocks.tobytes(),
+                                           b'index': index})
+        state = {b'info_hash': self.torrent.info_hash,
+                 b'partial': partial_pieces,
+                 b'pieces': have.tobytes()}
+        self._resume_version += 1
+        if self._closed:
+            # Only closing may block, the state has to be on disk then
+            self._write_resume(state, self._resume_version)
+            return
+        if self._saving is not None and not self._saving.done():
+            # A slow disk is still busy with the last save, the next one
+            # picks up the changes
+            return
+        loop = asyncio.get_event_loop()
+        self._saving = loop.run_in_executor(
+            None, self._write_resume, state, self._resume_version)
+
+    def _write_resume(self, state: dict, version: int):
+        with self._resume_lock:
+            if version < self._resume_written:
+                return
+            try:
+                write_resume(self.resume_file, state)
+            except OSError as e:
+                logging.warning('Unable to save resume state: {error}'
+                                .format(error=e))
+            self._resume_written = version
+
+    def _load_resume(self, state: dict):
+        have = bitstring.BitArray(bytes=state.get(b'pieces', b''))
+        for index in have.findall('0b1'):
+            if index >= self.total_pieces:
+                break
+            self._mark_have(index)
+
+        for partial in state.get(b'partial', []):
+            index = partial[b'index']
+            if not 0 <= index < self.total_pieces or \
+                    self.piece_states[index] != Piece.Missing:
+                continue
+            blocks = bitstring.BitArray(bytes=partial[b'blocks'])
+            if self.piece_priorities[index] == PRIORITY_SKIP or \
+                    self.buffers.exhausted:
+                # Loaded from the disk once the piece gets started
+                num_blocks = math.ceil(
+                    self.torrent.piece_size(index) / REQUEST_SIZE)
+                self.spilled[index] = [position for position in
+                                       blocks.findall('0b1')
+                                       if position < num_blocks]
+                continue
+            piece = self._start_piece(index)
+            pos = piece.index * self.torrent.piece_length
+            for position in blocks.findall('0b1'):
+                if position >= piece.num_blocks:
+                    break
+                block = piece.block(position)
+                piece.block_received(block.offset, self.writer.read(
+                    pos + block.offset, block.length))
+            if piece.is_complete():
+                # Would have been verified before stopping, get it again
+                piece.reset()
+            if self.streaming_hash:
+                piece.update_hash()
+        logging.info('Resuming with {have} pieces and {partial} partial '
+                     'pieces'.format(have=self.have_count,
+                                     partial=len(self.ongoing_pieces)))
+
+    async def recheck(self, executor=None):
+        """
+        Verify the data already present in the output file, hashing the
+        pieces through a memory map in a pool of processes.
+        """
+        loop = asyncio.get_event_loop()
+        piece_length = self.torrent.piece_length
+        batch = max(1, RECHECK_BATCH_SIZE // piece_length)
+        batches = range(0, self.total_pieces, batch)
+        logging.info('Rechecking {total} pieces in {path}'.format(
+            total=self.total_pieces, path=self.storage))
+
+        with executor or ProcessPoolExecutor() as pool:
+            results = await asyncio.gather(*[
+                loop.run_in_executor(
+                    pool, hash_pieces, self.files, piece_length,
+                    first, min(first + batch, self.total_pieces))
+                for first in batches])
+
+        hashes = self.torrent.pieces
+        for first, digests in zip(batches, results):
+            for index, digest in enumerate(digests, first):
+                if digest == hashes[index] and \
+                        self.piece_states[index] == Piece.Missing:
+                    self._mark_have(index)
+        logging.info('Recheck found {have} / {total} pieces'.format(
+            have=self.have_count, total=self.total_pieces))
+        self.needs_recheck = False
+        self.save_resume()
+
+    def _mark_have(self, index: int, written: bool = True):
+        self._account(index, -1)
+        self.piece_states[index] = Piece.Have if written else Piece.HavePart
+        if written:
+            self.have_bits[index] = 1
+        self.availability.untrack(index)
+        self.have_count += 1
+        for waiter in self._waiters.pop(index, []):
+            if not waiter.done():
+                waiter.set_result(None)
+
+    async def read(self, offset: int, length: int) -> bytes:
+        """
+        Read a range of the torrent data once the pieces holding it are
+        written, moving the read cursor to it. Skipped pieces in the range
+        are downloaded, data of skipped files can not be read.
+        """
+        if offset < 0 or length <= 0 or \
+                offset + length > self.torrent.total_size:
+            raise ValueError('Reading outside of the torrent data')
+        if not self._is_wanted(offset, length):
+            raise ValueError('Reading data of skipped files')
+        piece_length = self.torrent.piece_length
+        first = offset // piece_length
+        last = (offset + length - 1) // piece_length
+        self.read_cursor = first
+        loop = asyncio.get_event_loop()
+        # Wait for all the missing pieces at once, so every one of them is
+        # due and gets requested before any other piece
+        waiting = []
+        unskipped = False
+        for index in range(first, last + 1):
+            if self.piece_states[index] in (Piece.Have, Piece.HavePart):
+                continue
+            if self.piece_priorities[index] == PRIORITY_SKIP:
+                self.set_piece_priority(index, PRIORITY_HIGH)
+                unskipped = True
+            waiter = loop.create_future()
+            self._waiters.setdefault(index, []).append(waiter)
+            waiting.append((index, waiter))
+        if unskipped and self.on_resume_cb:
+            # Peers may be idle with everything else downloaded
+            self.on_resume_cb()
+        try:
+            await asyncio.gather(*(waiter for _, waiter in waiting))
+        finally:
+            for index, waiter in waiting:
+                waiters = self._waiters.get(index)
+                if waiters and waiter in waiters:
+                    waiters.remove(waiter)
+                    if not waiters:
+                        del self._waiters[index]
+        return await loop.run_in_executor(None, self.storage.read,
+                                          offset, length)
+
+    def has_piece(self, index: int) -> bool:
+        return self.piece_states[index] == Piece.Have
+
+    def bitfield(self) -> bytes:
+        """
+        The pieces we can upload as the payload of a BitField message, or
+        None if there are none
+        """
+        if not self.have_bits.any(True):
+            return None
+        return self.have_bits.tobytes()
+
+    def can_upload(self, index: int, begin: int, length: int) -> bool:
+        return (0 <= index < self.total_pieces and self.has_piece(index) and
+                begin >= 0 and
+                begin + length <= self.torrent.piece_size(index))
+
+    async def read_block(self, index: int, begin: int, length: int):
+        """
+        Read a block of a piece we have to upload it, or return None if it
+        can not be read
+        """
+        try:
+            return await self.read_cache.read(
+                index, begin, length, self.torrent.piece_size(index))
+        except OSError as e:
+            logging.error('Unable to read piece {index}: {error}'.format(
+                index=index, error=e))
+            return None
+
+    def block_segments(self, index: int, begin: int, length: int) -> list:
+        """
+        The (file index, file offset, length) segments of the files holding
+        a block, for sending it without reading it first
+        """
+        return list(self.storage.segments(
+            index * self.torrent.piece_length + begin, length))
+
+    def block_uploaded(self, length: int):
+        self.uploaded += length
+
+    @property
+    def congested(self) -> bool:
+        """
+        True when no new pieces should be started, since completed pieces
+        are already waiting for verification or to be written, or all the
+        staging memory is in use.
+        """
+        return (len(self.verify_backlog) > 0 or self.writer.congested or
+                self.buffers.exhausted)
+
+    def set_file_priority(self, index: int, priority: int):
+        """
+        Set the priority of a file. The pieces holding some of the file
+        get the highest priority of the files they hold, replacing any
+        priority set for them before.
+        """
+        file = self.torrent.files[index]
+        if not file.length:
+            self.file_priorities[index] = priority
+            return
+        piece_length = self.torrent.piece_length
+        pieces = range(file.offset // piece_length,
+                       (file.offset + file.length - 1) // piece_length + 1)
+        for piece_index in pieces:
+            self._account(piece_index, -1)
+        unskipped = self.file_priorities[index] == PRIORITY_SKIP and \
+            priority != PRIORITY_SKIP
+        self.file_priorities[index] = priority
+        for piece_index in pieces:
+            if unskipped and \
+                    self.piece_states[piece_index] == Piece.HavePart:
+                # The part in this file was never written, get it again
+                self.piece_states[piece_index] = Piece.Missing
+                self.availability.track(piece_index)
+                self.have_count -= 1
+            self._set_priority(piece_index, max(
+                self.file_priorities[i] for i, _, _ in
+                self.storage.segments(piece_index * piece_length,
+                                      self.torrent.piece_size(piece_index))))
+            self._account(piece_index, 1)
+
+    def set_piece_priority(self, index: int, priority: int):
+        """
+        Set the priority of a single piece. Pieces holding only data of
+        skipped files stay skipped.
+        """
+        self._account(index, -1)
+        self._set_priority(index, priority)
+        self._account(index, 1)
+
+    def _set_priority(self, index: int, priority: int):
+        if not self._wanted_bytes(index):
+            priority = PRIORITY_SKIP
+        self.availability.set_priority(index, priority)
+        piece = self.ongoing_pieces.get(index)
+        if priority == PRIORITY_SKIP and piece and not piece.is_complete():
+            self._abandon(piece)
+
+    def _account(self, index: int, sign: int):
+        # Count a piece in or out of what is left to download
+        if self.piece_priorities[index] != PRIORITY_SKIP and \
+                self.piece_states[index] not in (Piece.Have, Piece.HavePart):
+            self.wanted_left += sign
+            self.bytes_left += sign * self._wanted_bytes(index)
+
+    def _wanted_bytes(self, index: int) -> int:
+        return sum(size for file_index, _, size in self.storage.segments(
+            index * self.torrent.piece_length, self.torrent.piece_size(index))
+            if self.file_priorities[file_index] != PRIORITY_SKIP)
+
+    def _wanted_ranges(self, offset: int, length: int):
+        """
+        Yield the (offset, length) parts of the given range of the torrent
+        data that are not in skipped files
+        """
+        start = end = None
+        for index, file_offset, size in self.storage.segments(offset, length):
+            if self.file_priorities[index] == PRIORITY_SKIP:
+                continue
+            begin = self.torrent.files[index].offset + file_offset
+            if begin != end:
+                if start is not None:
+                    yield start, end - start
+                start = begin
+            end = begin + size
+        if start is not None:
+            yield start, end - start
+
+    def _is_wanted(self, offset: int, length: int) -> bool:
+        return list(self._wanted_ranges(offset, length)) == [(offset, length)]
+
+    def _abandon(self, piece):
+        # Stop downloading a piece that got skipped
+        del self.ongoing_pieces[piece.index]
+        self.partial_pieces.pop(piece.index, None)
+        for key in [key for key in self.pending_blocks
+                    if key[0] == piece.index]:
+            request = self.pending_blocks.pop(key)
+            for peer_id in request.peers:
+                self._cancel(peer_id, request.block)
+        positions = self._restoring.pop(piece.index, None)
+        if positions:
+            # Still on disk, for when the piece is wanted again
+            self.spilled[piece.index] = positions
+        piece.reset()
+        self.buffers.release(piece.buffer)
+        piece.buffer = None
+        self.piece_states[piece.index] = Piece.Missing
+        self.availability.track(piece.index)
+        self._resume()
 
     @property
     def complete(self):
-        return len(self.have_pieces) == self.total_pieces
+        return self.wanted_left == 0
 
     @property
     def bytes_downloaded(self) -> int:
-        return len(self.have_pieces) * self.torrent.piece_length
+        downloaded = self.have_count * self.torrent.piece_length
+        if self.has_piece(self.total_pieces - 1):
+            downloaded -= (self.torrent.piece_length -
+                           self.torrent.last_piece_length)
+        return downloaded
 
     @property
     def bytes_uploaded(self) -> int:
-        # TODO Add support for sending data
-        return 0
+        return self.uploaded
 
     def add_peer(self, peer_id, bitfield):
+        if len(bitfield) < self.total_pieces:
+            raise ProtocolError('BitField of {length} bits for {total} '
+                                'pieces'.format(length=len(bitfield),
+                                                total=self.total_pieces))
+        # The spare bits of the last byte are of no use
+        bitfield = bitfield[:self.total_pieces]
+        self.remove_peer(peer_id)
         self.peers[peer_id] = bitfield
+        self.timers[peer_id] = RequestTimer()
+        self.availability.add_bitfield(bitfield)
 
     def update_peer(self, peer_id, index: int):
-        if peer_id in self.peers:
+        if not 0 <= index < self.total_pieces:
+            return
+        if peer_id not in self.peers:
+            # Peers having no pieces yet may skip the BitField message
+            self.peers[peer_id] = bitstring.BitArray(self.total_pieces)
+            self.timers[peer_id] = RequestTimer()
+        if not self.peers[peer_id][index]:
             self.peers[peer_id][index] = 1
+            self.availability.increment(index)
 
     def remove_peer(self, peer_id):
         if peer_id in self.peers:
+            # Whatever was requested from the peer can go to others now
+            self.release_requests(peer_id)
+            self.availability.remove_bitfield(self.peers[peer_id])
             del self.peers[peer_id]
+            del self.timers[peer_id]
+
+    def release_requests(self, peer_id):
+        """
+        Give up on all blocks requested from the given peer, for instance
+        when it chokes us.
+        """
+        timer = self.timers.get(peer_id)
+        if timer:
+            for key in list(timer.pending):
+                self._release(key, peer_id)
+
+    def request_timeout(self, peer_id) -> float:
+        """
+        Seconds a block request to the given peer may take
+        """
+        timer = self.timers.get(peer_id)
+        maximum = self.max_pending_time / 1000
+        return timer.timeout(maximum) if timer else maximum
 
     def next_request(self, peer_id) -> Block:
         if peer_id not in self.peers:
             return None
 
-        block = self._expired_requests(peer_id)
+        self.expire_requests()
+        timer = self.timers[peer_id]
+        if timer.snubbed and timer.pending:
+            # One request at a time until the peer sends something again
+            return None
+
+        block = self._next_ongoing(peer_id)
+        if not block and self.buffers.exhausted:
+            # Peers that left may have stranded all of the staging memory
+            self._evict_stranded()
         if not block:
-            block = self._next_ongoing(peer_id)
-            if not block:
-                block = self._get_rarest_piece(peer_id).next_request()
+            if self.in_endgame:
+                block = self._endgame_request(peer_id)
+            elif self.congested:
+                # Peers are told through on_resume_cb when to ask again
+                self._stalled = True
+            else:
+                piece = self._get_due_piece(peer_id) or \
+                    self._get_rarest_piece(peer_id)
+                block = self._request_from(piece) if piece else None
+        if block:
+            self._add_request(block, peer_id)
         return block
 
+    def expire_requests(self) -> bool:
+        """
+        Give up on the requests not answered in time, so their blocks can
+        be requested from other peers. Returns True if any were given up.
+        """
+        now = time.monotonic()
+        expired = False
+        while self._deadlines and self._deadlines[0][0] <= now:
+            _, _, key, peer_id, requested = heapq.heappop(self._deadlines)
+            request = self.pending_blocks.get(key)
+            if request is None or request.peers.get(peer_id) != requested:
+                # Answered, or given up already
+                continue
+            expired = True
+            timer = self.timers[peer_id]
+            logging.info('Request for block {offset} of piece {index} to '
+                         'peer {peer} timed out'.format(
+                            offset=key[1], index=key[0], peer=peer_id))
+            if not timer.snubbed and \
+                    now - timer.last_active > SNUB_TIMEOUT:
+                logging.info('Peer {peer} is snubbing us'.format(
+                    peer=peer_id))
+                timer.snubbed = True
+                self.release_requests(peer_id)
+            else:
+                timer.backoff = min(timer.backoff * 2, 64)
+                self._release(key, peer_id)
+        return expired
+
     def block_received(self, peer_id, piece_index, block_offset, data):
         logging.debug('Received block {block_offset} for piece {piece_index} '
                       'from peer {peer_id}: '.format(block_offset=block_offset,
                                                      piece_index=piece_index,
                                                      peer_id=peer_id))
 
-        for index, request in enumerate(self.pending_blocks):
-            if request.block.piece == piece_index and \
-               request.block.offset == block_offset:
-                del self.pending_blocks[index]
-                break
+        now = time.monotonic()
+        timer = self.timers.get(peer_id)
+        if timer:
+            timer.last_active = now
+            timer.snubbed = False
+        request = self.pending_blocks.pop((piece_index, block_offset), None)
+        if request:
+            requested = request.peers.pop(peer_id, None)
+            if timer and requested is not None:
+                timer.pending.discard((piece_index, block_offset))
+                timer.sample(now - requested)
+            # Other peers asked for this block don't need to send it now
+            for other in request.peers:
+                self._cancel(other, request.block)
 
-        pieces = [p for p in self.ongoing_pieces if p.index == piece_index]
-        piece = pieces[0] if pieces else None
+        piece = self.ongoing_pieces.get(piece_index)
         if piece:
+            if piece.index in self.verifying or piece in self.verify_backlog:
+                # Late duplicate of a block in an already complete piece
+                return
             piece.block_received(block_offset, data)
-            if piece.is_complete():
-                if piece.is_hash_matching():
-                    self._write(piece)
-                    self.ongoing_pieces.remove(piece)
-                    self.have_pieces.append(piece)
-                    complete = (self.total_pieces -
-                                len(self.missing_pieces) -
-                                len(self.ongoing_pieces))
-                    logging.info(
-                        '{complete} / {total} pieces downloaded {per:.3f} %'
-                        .format(complete=complete,
-                                total=self.total_pieces,
-                                per=(complete/self.total_pieces)*100))
-                else:
-                    logging.info('Discarding corrupt piece {index}'
-                                 .format(index=piece.index))
-                    piece.reset()
+            self._check_piece(piece)
         else:
-            logging.warning('Trying to update piece that is not ongoing!')
-
-    def _expired_requests(self, peer_id) -> Block:
-        current = int(round(time.time() * 1000))
-        for request in self.pending_blocks:
-            if self.peers[peer_id][request.block.piece]:
-                if request.added + self.max_pending_time < current:
-                    logging.info('Re-requesting block {block} for '
-                                 'piece {piece}'.format(
-                                    block=request.block.offset,
-                                    piece=request.block.piece))
-                    # Reset expiration timer
-                    request.added = current
-                    return request.block
-        return None
+            # Duplicates of blocks in finished pieces are common in endgame
+            logging.debug('Dropping block {offset} of piece {index} that is '
+                          'not ongoing'.format(offset=block_offset,
+                                               index=piece_index))
+
+    def _check_piece(self, piece):
+        # Hash or verify what was received of the piece
+        if self.streaming_hash:
+            self._hash_blocks(piece)
+        elif piece.is_complete():
+            if len(self.verifying) < self.max_verifications:
+                self._verify(piece)
+            else:
+                self.verify_backlog.append(piece)
+
+    def _hash_blocks(self, piece):
+        """
+        Feed the blocks received in order to the running hash of the piece
+        on the verify executor, one job at a time per piece so they are
+        hashed in order. Blocks arriving meanwhile are picked up once the
+        job is done. The piece is verified when all of it is hashed.
+        """
+        job = piece.start_hashing()
+        if job is None:
+            if piece.is_hashed() and piece.is_complete():
+                self._piece_verified(piece, piece.is_hash_matching())
+            return
+        hasher, data, end = job
+        loop = asyncio.get_event_loop()
+        future = loop.run_in_executor(self.verify_executor, hasher.update,
+                                      data)
+        future.add_done_callback(functools.partial(
+            self._on_hashed, piece, hasher, data, end))
+
+    def _on_hashed(self, piece, hasher, data, end, future):
+        data.release()
+        if future.cancelled() or self._closed:
+            return
+        if future.exception() is not None:
+            logging.error('Unable to hash piece {index}: {error}'.format(
+                index=piece.index, error=future.exception()))
+        if not piece.hashed(hasher, end):
+            # Reset while hashing, started over with a new hash
+            return
+        if future.exception() is not None:
+            self._piece_verified(piece, False)
+            return
+        self._hash_blocks(piece)
+
+    def _verify(self, piece):
+        self.verifying[piece.index] = piece
+        loop = asyncio.get_event_loop()
+        future = loop.run_in_executor(self.verify_executor, piece_hash,
+                                      piece.buffer, piece.length)
+        future.add_done_callback(functools.partial(self._on_verified, piece))
+
+    def _on_verified(self, piece, future):
+        del self.verifying[piece.index]
+        if self.verify_backlog:
+            self._verify(self.verify_backlog.popleft())
+            self._resume()
+        if future.cancelled():
+            return
+        if future.exception() is not None:
+            logging.error('Unable to verify piece {index}: {error}'.format(
+                index=piece.index, error=future.exception()))
+
+        matching = future.exception() is None and \
+            future.result() == piece.hash
+        self._piece_verified(piece, matching)
+
+    def _piece_verified(self, piece, matching: bool):
+        if matching:
+            del self.ongoing_pieces[piece.index]
+            self._write(piece)
+        else:
+            logging.info('Discarding corrupt piece {index}'
+                         .format(index=piece.index))
+            piece.reset()
+            self.partial_pieces[piece.index] = piece
+
+    def _add_request(self, block, peer_id):
+        key = (block.piece, block.offset)
+        request = self.pending_blocks.get(key)
+        if request is None:
+            request = PendingRequest(block, {})
+            self.pending_blocks[key] = request
+        now = time.monotonic()
+        timer = self.timers[peer_id]
+        if not timer.pending:
+            timer.last_active = now
+        timer.pending.add(key)
+        request.peers[peer_id] = now
+        self._sequence += 1
+        heapq.heappush(self._deadlines, (
+            now + self.request_timeout(peer_id), self._sequence, key,
+            peer_id, now))
+        if len(self._deadlines) > 64 + \
+                4 * ENDGAME_COPIES * len(self.pending_blocks):
+            # Mostly answered requests, drop them all at once
+            self._deadlines = [
+                entry for entry in self._deadlines
+                if entry[2] in self.pending_blocks and
+                self.pending_blocks[entry[2]].peers.get(entry[3]) ==
+                entry[4]]
+            heapq.heapify(self._deadlines)
+
+    def _release(self, key, peer_id):
+        # Withdraw the request to one peer, the block can be requested
+        # again once no other peer has it requested
+        request = self.pending_blocks[key]
+        del request.peers[peer_id]
+        self._cancel(peer_id, request.block)
+        if request.peers:
+            return
+        del self.pending_blocks[key]
+        piece = self.ongoing_pieces.get(key[0])
+        if piece:
+            piece.release(key[1])
+            self.partial_pieces[piece.index] = piece
+            # Blocks given up on are overdue, request them first
+            self.partial_pieces.move_to_end(piece.index, last=False)
+
+    def _cancel(self, peer_id, block):
+        timer = self.timers.get(peer_id)
+        if timer:
+            timer.pending.discard((block.piece, block.offset))
+        if self.on_cancel_cb:
+            self.on_cancel_cb(peer_id, block)
 
     def _next_ongoing(self, peer_id) -> Block:
-        for piece in self.ongoing_pieces:
+        # Blocks of pieces a read is waiting for are requested first
+        for index in self._waiters:
+            piece = self.partial_pieces.get(index)
+            if piece and self.peers[peer_id][index]:
+                return self._request_from(piece)
+        for piece in self.partial_pieces.values():
             if self.peers[peer_id][piece.index]:
                 # Is there any blocks left to request in this piece?
-                block = piece.next_request()
-                if block:
-                    self.pending_blocks.append(
-                        PendingRequest(block, int(round(time.time() * 1000))))
-                    return block
+                return self._request_from(piece)
         return None
 
-    def _get_rarest_piece(self, peer_id):
-        piece_count = defaultdict(int)
-        for piece in self.missing_pieces:
-            if not self.peers[peer_id][piece.index]:
+    @property
+    def in_endgame(self) -> bool:
+        """
+        True once every block still to be downloaded has been requested,
+        no other pieces are left to start.
+        """
+        return (not self.partial_pieces and len(self.pending_blocks) > 0 and
+                self.wanted_left <=
+                len(self.ongoing_pieces) + len(self.writing))
+
+    def _endgame_request(self, peer_id) -> Block:
+        """
+        Hand out a pending block this peer was not asked for yet, so the
+        last blocks are not held up by a single slow peer. Blocks asked
+        from the fewest peers go first.
+        """
+        if not self._endgame:
+            self._endgame = True
+            logging.info('Entering endgame with {count} pending blocks'
+                         .format(count=len(self.pending_blocks)))
+        bitfield = self.peers[peer_id]
+        best = None
+        for request in self.pending_blocks.values():
+            if peer_id in request.peers or \
+                    len(request.peers) >= ENDGAME_COPIES or \
+                    not bitfield[request.block.piece]:
                 continue
-            for p in self.peers:
-                if self.peers[p][piece.index]:
-                    piece_count[piece] += 1
+            if best is None or len(request.peers) < len(best.peers):
+                best = request
+                if len(best.peers) <= 1:
+                    break
+        return best.block if best else None
+
+    def _request_from(self, piece) -> Block:
+        block = piece.next_request()
+        if not piece.has_missing():
+            self.partial_pieces.pop(piece.index, None)
+        return block
+
+    def _due_pieces(self):
+        """
+        Yield the indices of the pieces in the order they are needed, the
+        pieces reads are waiting for, then when streaming the pieces after
+        the read cursor.
+        """
+        yield from self._waiters
+        if self.streaming:
+            yield from range(self.read_cursor, min(
+                self.read_cursor + self.streaming_window, self.total_pieces))
 
-        rarest_piece = min(piece_count, key=lambda p: piece_count[p])
-        self.missing_pieces.remove(rarest_piece)
-        self.ongoing_pieces.append(rarest_piece)
-        return rarest_piece
+    def _get_due_piece(self, peer_id):
+        if self.buffers.exhausted:
+            return None
+        bitfield = self.peers[peer_id]
+        for index in self._due_pieces():
+            if self.piece_states[index] == Piece.Missing and \
+                    self.piece_priorities[index] != PRIORITY_SKIP and \
+                    bitfield[index]:
+                return self._start_piece(index)
+        return None
+
+    def _get_rarest_piece(self, peer_id):
+        if self.buffers.exhausted:
+            # Staging memory is used up by the pieces already ongoing
+            return None
+        index = self.availability.rarest(self.peers[peer_id])
+        if index is None:
+            return None
+        return self._start_piece(index)
 
     def _next_missing(self, peer_id) -> Block:
-        for index, piece in enumerate(self.missing_pieces):
-            if self.peers[peer_id][piece.index]:
-                # Move this piece from missing to ongoing
-                piece = self.missing_pieces.pop(index)
-                self.ongoing_pieces.append(piece)
+        if self.buffers.exhausted:
+            return None
+        for index, state in enumerate(self.piece_states):
+            if state == Piece.Missing and self.peers[peer_id][index] and \
+                    self.piece_priorities[index] != PRIORITY_SKIP:
+                piece = self._start_piece(index)
                 # The missing pieces does not have any previously requested
                 # blocks (then it is ongoing).
-                return piece.next_request()
+                return self._request_from(piece)
         return None
 
+    def _start_piece(self, index: int) -> Piece:
+        # Move this piece from missing to ongoing
+        self.piece_states[index] = Piece.Ongoing
+        self.availability.untrack(index)
+        piece = self._new_piece(index)
+        piece.buffer = self.buffers.acquire()
+        self.ongoing_pieces[index] = piece
+        self.partial_pieces[index] = piece
+        positions = self.spilled.pop(index, None)
+        if positions:
+            self._restore(piece, positions)
+        return piece
+
+    def _evict_stranded(self):
+        """
+        When every ongoing piece is one no connected peer has, their buffers
+        would never be freed and no new piece could be started. Spill one
+        of them to disk the way close() does and free its buffer, its
+        blocks are loaded back once the piece is started again.
+        """
+        if self.writing or self.verifying or self.verify_backlog:
+            # Buffers are about to be freed anyway
+            return
+        counts = self.availability.counts
+        for piece in self.ongoing_pieces.values():
+            if piece.is_complete() or counts[piece.index]:
+                # Its buffer is freed once the piece is done
+                return
+        if not self.ongoing_pieces:
+            return
+        _, piece = self.ongoing_pieces.popitem(last=False)
+        index = piece.index
+        logging.info('Spilling stranded piece {index} to disk'.format(
+            index=index))
+        self.partial_pieces.pop(index, None)
+        for key in [key for key in self.pending_blocks if key[0] == index]:
+            request = self.pending_blocks.pop(key)
+            for peer_id in request.peers:
+                self._cancel(peer_id, request.block)
+
+        pos = index * self.torrent.piece_length
+        positions = self._restoring.pop(index, [])
+        writes = []
+        for block in piece.blocks:
+            if block.status == Block.Retrieved and \
+                    self._is_wanted(pos + block.offset, block.length):
+                positions.append(block.offset // REQUEST_SIZE)
+                # The buffer is reused before the write is done
+                writes.append((pos + block.offset, bytes(
+                    piece.data[block.offset:block.offset + block.length])))
+        # Writes left and the first error, shared by the callbacks
+        pending = [len(writes), None]
+        for offset, data in writes:
+            self.writer.write(offset, [data], functools.partial(
+                self._on_spilled, index, positions, pending))
+        if not writes and positions:
+            self.spilled[index] = positions
+
+        piece.reset()
+        self.buffers.release(piece.buffer)
+        piece.buffer = None
+        self.piece_states[index] = Piece.Missing
+        self.availability.track(index)
+        # Stalled peers may start a piece now, once this request is done
+        asyncio.get_event_loop().call_soon(self._resume)
+
+    def _on_spilled(self, index, positions, pending, error):
+        if error is not None and pending[1] is None:
+            pending[1] = error
+        pending[0] -= 1
+        if pending[0]:
+            return
+        if pending[1] is not None:
+            logging.warning('Unable to spill piece {index}: {error}'.format(
+                index=index, error=pending[1]))
+        elif self.piece_states[index] == Piece.Missing:
+            # Only readable from the disk once written
+            self.spilled[index] = positions
+
+    def _restore(self, piece, positions):
+        """
+        Load the blocks of a piece spilled to disk back into its buffer off
+        the event loop, they are not requested from peers meanwhile
+        """
+        pos = piece.index * self.torrent.piece_length
+        blocks = [piece.block(position) for position in positions]
+        for position in positions:
+            piece.reserve(position)
+        if not piece.has_missing():
+            self.partial_pieces.pop(piece.index, None)
+        self._restoring[piece.index] = positions
+
+        def read():
+            return [self.writer.read(pos + block.offset, block.length)
+                    for block in blocks]
+        future = asyncio.get_event_loop().run_in_executor(None, read)
+        future.add_done_callback(functools.partial(
+            self._on_restored, piece, blocks))
+
+    def _on_restored(self, piece, blocks, future):
+        if self._closed or self.ongoing_pieces.get(piece.index) is not piece:
+            # Spilled or abandoned again meanwhile
+            return
+        del self._restoring[piece.index]
+        if future.cancelled() or future.exception() is not None:
+            logging.warning('Unable to load piece {index}: {error}'.format(
+                index=piece.index,
+                error=None if future.cancelled() else future.exception()))
+            data = [b''] * len(blocks)
+        else:
+            data = future.result()
+        for block, block_data in zip(blocks, data):
+            if len(block_data) == block.length:
+                piece.block_received(block.offset, block_data)
+            else:
+                # Requested from peers after all
+                piece.release(block.offset)
+                self.partial_pieces[piece.index] = piece
+        self._check_piece(piece)
+
+    def _resume(self):
+        if self._stalled and not self.congested:
+            self._stalled = False
+            if self.on_resume_cb:
+                self.on_resume_cb()
+
     def _write(self, piece):
+        self.writing[piece.index] = piece
         pos = piece.index * self.torrent.piece_length
-        os.lseek(self.fd, pos, os.SEEK_SET)
-        os.write(self.fd, piece.data)
+        # Parts of the piece in skipped files are never written
+        ranges = list(self._wanted_ranges(pos, piece.length))
+        written = ranges == [(pos, piece.length)]
+        # Writes left and the first error, shared by the callbacks
+        pending = [max(1, len(ranges)), None]
+        callback = functools.partial(self._on_written, piece, pending,
+                                     written)
+        if not ranges:
+            asyncio.get_event_loop().call_soon(callback, None)
+        for offset, length in ranges:
+            self.writer.write(offset, [
+                piece.data[offset - pos:offset - pos + length]], callback)
+
+    def _on_written(self, piece, pending, written, error):
+        pending[0] -= 1
+        pending[1] = pending[1] or error
+        if pending[0]:
+            return
+        error = pending[1]
+        del self.writing[piece.index]
+        # The data is on disk (or lost), the buffer can be reused
+        self.buffers.release(piece.buffer)
+        piece.buffer = None
+        self._resume()
+        if error:
+            # Nothing is lost but the download, get the piece again
+            piece.reset()
+            self.piece_states[piece.index] = Piece.Missing
+            self.availability.track(piece.index)
+            return
+
+        self._mark_have(piece.index, written)
+        if written and self.on_have_cb:
+            self.on_have_cb(piece.index)
+        complete = self.have_count
+        logging.info(
+            '{complete} / {total} pieces downloaded {per:.3f} %'
+            .format(complete=complete,
+                    total=self.total_pieces,
+                    per=(complete/self.total_pieces)*100))
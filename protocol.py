@@ -2,13 +2,29 @@
 
 import asyncio
 import logging
+import math
 import struct
+import time
 from asyncio import Queue
+from collections import OrderedDict, deque
 from concurrent.futures import CancelledError
 
 import bitstring
+
+from bandwidth import Traffic
 REQUEST_SIZE = 2**14
 
+# Bounds for the number of block requests kept in flight to a single peer
+MIN_QUEUE_DEPTH = 2
+MAX_QUEUE_DEPTH = 128
+# Queue depth used until the first throughput sample is available
+INITIAL_QUEUE_DEPTH = 4
+
+# Largest block a peer may request from us
+MAX_REQUEST_SIZE = 2**17
+# Most requests from a peer queued for uploading, the rest are dropped
+MAX_UPLOAD_QUEUE = 256
+
 
 class ProtocolError(BaseException):
     pass
@@ -16,7 +32,11 @@ class ProtocolError(BaseException):
 
 class PeerConnection:
     def __init__(self, queue: Queue, info_hash,
-                 peer_id, piece_manager, on_block_cb=None):
+                 peer_id, piece_manager, on_block_cb=None,
+                 use_protocol: bool = False, use_sendfile: bool = False,
+                 on_interested_cb=None, session_download: Traffic = None,
+                 session_upload: Traffic = None, download_limit: int = 0,
+                 upload_limit: int = 0, is_connected_cb=None):
         self.my_state = []
         self.peer_state = []
         self.queue = queue
@@ -27,60 +47,46 @@ class PeerConnection:
         self.reader = None
         self.piece_manager = piece_manager
         self.on_block_cb = on_block_cb
+        self.on_interested_cb = on_interested_cb
+        # Tells whether another connection to a peer id is open already
+        self.is_connected_cb = is_connected_cb
+        self.use_protocol = use_protocol
+        self.use_sendfile = use_sendfile
+        self.pipeline = RequestPipeline()
+        # Traffic of the whole session, and limits of every single peer
+        self.session_download = session_download
+        self.session_upload = session_upload
+        self.download_limit = download_limit
+        self.upload_limit = upload_limit
+        self._new_traffic()
+        # Seconds to stop reading from the peer to stay within the limits
+        self._download_delay = 0
+        # Requests from the peer waiting to be served, oldest first
+        self.upload_queue = deque()
+        self._upload_ready = asyncio.Event()
+        self._uploader = None
+        self._protocol = None
+        # Messages written while a sendfile() owns the transport
+        self._held = None
+        # Resolved with an accepted connection while waiting for a peer
+        self._accepted = None
         self.future = asyncio.ensure_future(self._start())  # Start this worker
 
     async def _start(self):
         while 'stopped' not in self.my_state:
-            ip, port = await self.queue.get()
-            logging.info('Got assigned peer with: {ip}'.format(ip=ip))
+            ip, port, sock = await self._next_peer()
+            if sock is None:
+                logging.info('Got assigned peer with: {ip}'.format(ip=ip))
+            else:
+                logging.info('Accepted connection from: {ip}'.format(ip=ip))
 
             try:
-                self.reader, self.writer = await asyncio.open_connection(
-                    ip, port)  # 异步TCP请求
-                logging.info('Connection open to peer: {ip}'.format(ip=ip))
-
-                buffer = await self._handshake()
-                self.my_state.append('choked')
-
-                await self._send_interested()
-                self.my_state.append('interested')
-
-                async for message in PeerStreamIterator(self.reader, buffer):
-                    if 'stopped' in self.my_state:
-                        break
-                    if type(message) is BitField:
-                        self.piece_manager.add_peer(self.remote_id,
-                                                    message.bitfield)
-                    elif type(message) is Interested:
-                        self.peer_state.append('interested')
-                    elif type(message) is NotInterested:
-                        if 'interested' in self.peer_state:
-                            self.peer_state.remove('interested')
-                    elif type(message) is Choke:
-                        self.my_state.append('choked')
-                    elif type(message) is Unchoke:
-                        if 'choked' in self.my_state:
-                            self.my_state.remove('choked')
-                    elif type(message) is Have:
-                        self.piece_manager.update_peer(self.remote_id,
-                                                       message.index)
-                    elif type(message) is KeepAlive:
-                        pass
-                    elif type(message) is Piece:
-                        self.my_state.remove('pending_request')
-                        self.on_block_cb(
-                            peer_id=self.remote_id,
-                            piece_index=message.index,
-                            block_offset=message.begin,
-                            data=message.block)
-                    elif type(message) is Request or type(message) is Cancel:
-                        pass
-
-                    if 'choked' not in self.my_state:
-                        if 'interested' in self.my_state:
-                            if 'pending_request' not in self.my_state:
-                                self.my_state.append('pending_request')
-                                await self._request_piece()
+                self.pipeline = RequestPipeline()
+                self._new_traffic()
+                if self.use_protocol:
+                    await self._run_protocol(ip, port, sock)
+                else:
+                    await self._run_stream(ip, port, sock)
 
             except ProtocolError as e:
                 logging.exception('Protocol error')
@@ -88,29 +94,274 @@ class PeerConnection:
                 logging.warning('Unable to connect to peer')
             except (ConnectionResetError, CancelledError):
                 logging.warning('Connection closed')
-            except Exception as e:
+            except (OSError, asyncio.IncompleteReadError) as e:
+                logging.warning('Connection to peer failed: {error}'.format(
+                    error=e))
+            except Exception:
+                # Whatever a peer makes us do wrong, only its own connection
+                # is dropped
                 logging.exception('An error occurred')
-                self.cancel()
-                raise e
-            self.cancel()
+            # The worker goes on with the next peer
+            self._disconnect(queued=sock is None)
+
+    async def _next_peer(self):
+        """
+        Wait for the address of a peer to connect to, or for a connection
+        handed over by accept(). Returns the ip, port and the socket of an
+        accepted connection, which is None for an address.
+        """
+        self._accepted = asyncio.get_event_loop().create_future()
+        queued = asyncio.ensure_future(self.queue.get())
+        try:
+            await asyncio.wait((queued, self._accepted),
+                               return_when=asyncio.FIRST_COMPLETED)
+        finally:
+            accepted, self._accepted = self._accepted, None
+            queued.cancel()
+            accepted.cancel()
+        if accepted.done() and not accepted.cancelled():
+            if queued.done() and not queued.cancelled():
+                # Both came at once, leave the address to another worker
+                self.queue.put_nowait(queued.result())
+                self.queue.task_done()
+            sock, address = accepted.result()
+            return address[0], address[1], sock
+        ip, port = queued.result()
+        return ip, port, None
+
+    @property
+    def idle(self) -> bool:
+        """
+        True while waiting for a peer, when accept() may be called
+        """
+        return self._accepted is not None and not self._accepted.done()
+
+    def accept(self, sock, address):
+        """
+        Hand an incoming connection to this idle worker
+        """
+        self._accepted.set_result((sock, address))
+
+    async def _run_stream(self, ip, port, sock=None):
+        if sock is None:
+            self.reader, self.writer = await asyncio.open_connection(
+                ip, port)  # 异步TCP请求
+        else:
+            self.reader, self.writer = await asyncio.open_connection(
+                sock=sock)
+        logging.info('Connection open to peer: {ip}'.format(ip=ip))
+
+        buffer = await self._handshake()
+        self.my_state.append('choked')
+        self._start_upload()
+
+        await self._send_interested()
+        self.my_state.append('interested')
+
+        async for message in PeerStreamIterator(
+                self.reader, buffer, self.max_message_length):
+            if 'stopped' in self.my_state:
+                break
+            self._handle_message(message)
+            if self._request_pieces():
+                await self.writer.drain()
+            delay = self.take_download_delay()
+            if delay:
+                # Not reading lets the peer's data wait in the socket
+                await asyncio.sleep(delay)
+
+    async def _run_protocol(self, ip, port, sock=None):
+        loop = asyncio.get_event_loop()
+        if sock is None:
+            _, protocol = await loop.create_connection(
+                lambda: PeerProtocol(self), ip, port)
+        else:
+            _, protocol = await loop.connect_accepted_socket(
+                lambda: PeerProtocol(self), sock)
+        logging.info('Connection open to peer: {ip}'.format(ip=ip))
+        await protocol.closed
+
+    def _on_handshake(self, remote_id):
+        self._check_remote_id(remote_id)
+        self.remote_id = remote_id
+        logging.info('Handshake successful !')
+        self.my_state.append('choked')
+        self._start_upload()
+
+        message = Interested()
+        logging.debug('Sending message: {type}'.format(type=message))
+        self._write(message.encode())
+        self.my_state.append('interested')
+
+    def _handle_message(self, message):
+        if type(message) is BitField:
+            self.piece_manager.add_peer(self.remote_id,
+                                        message.bitfield)
+        elif type(message) is Interested:
+            if 'interested' not in self.peer_state:
+                self.peer_state.append('interested')
+                if self.on_interested_cb:
+                    self.on_interested_cb(self)
+        elif type(message) is NotInterested:
+            if 'interested' in self.peer_state:
+                self.peer_state.remove('interested')
+        elif type(message) is Choke:
+            self.my_state.append('choked')
+            # A choking peer discards all our pending requests
+            self.pipeline.clear()
+            self.piece_manager.release_requests(self.remote_id)
+        elif type(message) is Unchoke:
+            if 'choked' in self.my_state:
+                self.my_state.remove('choked')
+        elif type(message) is Have:
+            self.piece_manager.update_peer(self.remote_id,
+                                           message.index)
+        elif type(message) is KeepAlive:
+            pass
+        elif type(message) is Piece:
+            self.pipeline.received(message.index, message.begin,
+                                   len(message.block))
+            self._download_delay = max(
+                self._download_delay,
+                self.download.transferred(len(message.block)))
+            self.on_block_cb(
+                peer_id=self.remote_id,
+                piece_index=message.index,
+                block_offset=message.begin,
+                data=message.block)
+        elif type(message) is Request:
+            self._queue_upload(message)
+        elif type(message) is Cancel:
+            self._cancel_upload(message)
 
     def cancel(self):
-        logging.info('Closing peer {id}'.format(id=self.remote_id))
         if not self.future.done():
             self.future.cancel()
+        self._disconnect()
+
+    def _disconnect(self, queued: bool = True):
+        """
+        Close the connection to the current peer and forget its state, the
+        worker can take another peer afterwards
+        """
+        logging.info('Closing peer {id}'.format(id=self.remote_id))
+        if self.remote_id:
+            self.piece_manager.remove_peer(self.remote_id)
+        if self._uploader:
+            self._uploader.cancel()
+            self._uploader = None
+        self.upload_queue.clear()
         if self.writer:
             self.writer.close()
+        self.writer = None
+        self.reader = None
+        self._protocol = None
+        self._held = None
+        self.remote_id = None
+        self.my_state = [state for state in self.my_state
+                         if state == 'stopped']
+        self.peer_state = []
+        self._download_delay = 0
 
-        self.queue.task_done()
+        if queued:
+            self.queue.task_done()
 
     def stop(self):
         self.my_state.append('stopped')
         if not self.future.done():
             self.future.cancel()
 
-    async def _request_piece(self):
-        block = self.piece_manager.next_request(self.remote_id)
-        if block:
+    def _new_traffic(self):
+        self.download = Traffic(self.download_limit,
+                                parent=self.session_download)
+        self.upload = Traffic(self.upload_limit, parent=self.session_upload)
+
+    def take_download_delay(self) -> float:
+        """
+        Return for how long reading should pause for the download limits,
+        if at all
+        """
+        delay, self._download_delay = self._download_delay, 0
+        return delay
+
+    @property
+    def max_message_length(self) -> int:
+        """
+        Largest length prefix accepted from the peer, a Piece message with
+        the largest block we request or a BitField of the torrent
+        """
+        return max(MAX_REQUEST_SIZE,
+                   math.ceil(self.piece_manager.total_pieces / 8)) + 13
+
+    @property
+    def connected(self) -> bool:
+        return self.writer is not None and self.remote_id is not None and \
+            not self.writer.is_closing()
+
+    @property
+    def peer_interested(self) -> bool:
+        return 'interested' in self.peer_state
+
+    @property
+    def choking(self) -> bool:
+        """
+        True while we refuse to upload to the peer
+        """
+        return 'choked' in self.peer_state
+
+    def choke(self):
+        if self.connected and not self.choking:
+            self.peer_state.append('choked')
+            # The peer knows its outstanding requests are discarded
+            self.upload_queue.clear()
+            self._write(Choke().encode())
+
+    def unchoke(self):
+        if self.connected and self.choking:
+            self.peer_state.remove('choked')
+            self._write(Unchoke().encode())
+
+    def resume_requests(self):
+        """
+        Fill the request window outside of the message loop, used when the
+        piece manager is able to hand out blocks again.
+        """
+        if self.connected:
+            self._request_pieces()
+
+    def send_have(self, index: int):
+        """
+        Announce a piece we just completed
+        """
+        if self.connected:
+            self._write(Have(index).encode())
+
+    def cancel_request(self, index: int, begin: int, length: int):
+        """
+        Withdraw the request for a block that was received from another
+        peer, freeing its slot in the request window.
+        """
+        if self.pipeline.cancel(index, begin) and self.writer and \
+                not self.writer.is_closing():
+            self._write(Cancel(index, begin, length).encode())
+
+    def _request_pieces(self) -> int:
+        """
+        Fill the request window and return the number of requests written
+        """
+        if 'choked' in self.my_state or 'interested' not in self.my_state:
+            return 0
+
+        # Requests older than the piece manager's timeout are re-issued
+        # elsewhere, so they should not keep occupying our window.
+        self.pipeline.expire(
+            self.piece_manager.request_timeout(self.remote_id))
+
+        requested = 0
+        while self.pipeline.free > 0:
+            block = self.piece_manager.next_request(self.remote_id)
+            if not block:
+                break
             message = Request(block.piece, block.offset, block.length).encode()
 
             logging.debug('Requesting block {block} for piece {piece} '
@@ -120,7 +371,141 @@ class PeerConnection:
                             length=block.length,
                             peer=self.remote_id))
 
-            self.writer.write(message)
+            self.pipeline.add(block.piece, block.offset, block.length)
+            self._write(message)
+            requested += 1
+        return requested
+
+    def _start_upload(self):
+        # The peer stays choked until the choker gives it a slot
+        self.peer_state.append('choked')
+        bitfield = self.piece_manager.bitfield()
+        if bitfield:
+            self._write(BitField(bitfield).encode())
+        self._uploader = asyncio.ensure_future(self._upload())
+
+    def _queue_upload(self, request):
+        if 'choked' in self.peer_state or \
+                len(self.upload_queue) >= MAX_UPLOAD_QUEUE or \
+                not 0 < request.length <= MAX_REQUEST_SIZE or \
+                not self.piece_manager.can_upload(request.index,
+                                                  request.begin,
+                                                  request.length):
+            logging.debug('Ignoring request for block {begin} of piece '
+                          '{index} from peer {peer}'.format(
+                            begin=request.begin, index=request.index,
+                            peer=self.remote_id))
+            return
+        self.upload_queue.append(request)
+        self._upload_ready.set()
+
+    def _cancel_upload(self, cancel):
+        for request in self.upload_queue:
+            if request.index == cancel.index and \
+                    request.begin == cancel.begin and \
+                    request.length == cancel.length:
+                self.upload_queue.remove(request)
+                break
+
+    async def _upload(self):
+        """
+        Serve the queued requests of the peer one after another, waiting
+        for the written data to drain before reading the next block.
+        """
+        while True:
+            if not self.upload_queue:
+                self._upload_ready.clear()
+                await self._upload_ready.wait()
+                continue
+            request = self.upload_queue.popleft()
+            if 'choked' in self.peer_state or self.writer.is_closing():
+                continue
+            if self.use_sendfile:
+                sent = await self._sendfile_block(request)
+            else:
+                sent = await self._send_block(request)
+            if sent:
+                self.piece_manager.block_uploaded(request.length)
+                delay = self.upload.transferred(request.length)
+                await self._drain()
+                if delay:
+                    await asyncio.sleep(delay)
+
+    async def _send_block(self, request) -> bool:
+        data = await self.piece_manager.read_block(
+            request.index, request.begin, request.length)
+        if not data or 'choked' in self.peer_state or \
+                self.writer.is_closing():
+            return False
+        # Written apart from the header, sparing a copy of the block
+        self._write(Piece.header(request.index, request.begin, len(data)))
+        self._write(data)
+        return True
+
+    async def _sendfile_block(self, request) -> bool:
+        """
+        Write only the message header and let the kernel copy the block from
+        the files to the socket. Falls back to reading the block when the
+        transport or the platform has no sendfile().
+        """
+        loop = asyncio.get_event_loop()
+        storage = self.piece_manager.storage
+        transport = self.writer if self._protocol else self.writer.transport
+        self._write(Piece.header(request.index, request.begin,
+                                 request.length))
+        # The transport refuses writes until sendfile() is done, other
+        # messages are held back and written after the block
+        self._held = []
+        sent = 0
+        try:
+            for index, offset, size in self.piece_manager.block_segments(
+                    request.index, request.begin, request.length):
+                if transport.is_closing():
+                    return False
+                try:
+                    with storage.open_file(index) as file:
+                        await loop.sendfile(transport, file, offset, size,
+                                            fallback=False)
+                except (asyncio.SendfileNotAvailableError,
+                        RuntimeError) as e:
+                    logging.warning('Unable to use sendfile, falling back '
+                                    'to buffered sends: {error}'.format(
+                                        error=e))
+                    self.use_sendfile = False
+                    break
+                sent += size
+            if sent < request.length:
+                data = await self.piece_manager.read_block(
+                    request.index, request.begin + sent,
+                    request.length - sent)
+                if not data or transport.is_closing():
+                    # The peer already got the header, there is no way to
+                    # continue the connection without the block
+                    self.writer.close()
+                    return False
+                self.writer.write(data)
+        except OSError as e:
+            logging.warning('Unable to send block {begin} of piece {index}: '
+                            '{error}'.format(begin=request.begin,
+                                             index=request.index, error=e))
+            self.writer.close()
+            return False
+        finally:
+            held, self._held = self._held, None
+            for data in held:
+                self._write(data)
+        return True
+
+    def _write(self, data):
+        if self._held is not None:
+            self._held.append(data)
+        elif not self.writer.is_closing():
+            self.writer.write(data)
+
+    async def _drain(self):
+        if self._protocol:
+            await self._protocol.drain()
+        else:
             await self.writer.drain()
 
     async def _handshake(self):
@@ -131,7 +516,7 @@ class PeerConnection:
         tries = 1
         while len(buf) < Handshake.length and tries < 10:
             tries += 1
-            buf = await self.reader.read(PeerStreamIterator.CHUNK_SIZE)
+            buf += await self.reader.read(PeerStreamIterator.CHUNK_SIZE)
 
         response = Handshake.decode(buf[:Handshake.length])
         if not response:
@@ -139,11 +524,24 @@ class PeerConnection:
         if not response.info_hash == self.info_hash:
             raise ProtocolError('Handshake with invalid info_hash')
 
+        self._check_remote_id(response.peer_id)
         self.remote_id = response.peer_id
         logging.info('Handshake successful !')
 
         return buf[Handshake.length:]
 
+    def _check_remote_id(self, remote_id):
+        own_id = self.peer_id
+        if isinstance(own_id, str):
+            own_id = own_id.encode('utf-8')
+        if remote_id == own_id:
+            raise ProtocolError('Connected to ourselves')
+        if self.is_connected_cb and self.is_connected_cb(remote_id):
+            # Checked before remote_id is set, closing this connection
+            # must leave the state of the other one alone
+            raise ProtocolError('Already connected to peer {id}'.format(
+                id=remote_id))
+
     async def _send_interested(self):
         message = Interested()
         logging.debug('Sending message: {type}'.format(type=message))
@@ -151,31 +549,250 @@ class PeerConnection:
         await self.writer.drain()
 
 
+class PeerProtocol(asyncio.BufferedProtocol):
+    """
+    Low-level peer transport used instead of the StreamReader polling when
+    the PeerConnection is created with `use_protocol`.
+
+    The event loop reads straight into the free space of a MessageBuffer
+    and every complete message is dispatched synchronously to the owning
+    PeerConnection, without a coroutine switch per message. When the
+    transport cannot keep up with our writes, reading from the peer is
+    paused until the write buffer drains.
+    """
+    def __init__(self, connection: PeerConnection):
+        self.connection = connection
+        self.transport = None
+        self.buffer = MessageBuffer(
+            max_length=connection.max_message_length)
+        self.closed = asyncio.get_event_loop().create_future()
+        self._handshaken = False
+        self._paused = False
+        self._writing_paused = False
+        # Resolved once the transport takes writes again
+        self._drain_waiter = None
+        # Timer ending a pause of reading for the download limits
+        self._throttle = None
+
+    def connection_made(self, transport):
+        self.transport = transport
+        connection = self.connection
+        # The transport exposes the write() and close() used on the writer
+        connection.writer = transport
+        connection._protocol = self
+        transport.write(
+            Handshake(connection.info_hash, connection.peer_id).encode())
+
+    def get_buffer(self, sizehint: int):
+        return self.buffer.get_buffer(sizehint)
+
+    def buffer_updated(self, nbytes: int):
+        self.buffer.buffer_updated(nbytes)
+        try:
+            if not self._handshaken and not self._on_handshake():
+                return
+            connection = self.connection
+            while not self.transport.is_closing():
+                message = self.buffer.next_message()
+                if not message:
+                    break
+                connection._handle_message(message)
+            connection._request_pieces()
+            delay = connection.take_download_delay()
+            if delay:
+                self.throttle(delay)
+        except ProtocolError as e:
+            self._close(e)
+        except Exception as e:
+            logging.exception('Error when dispatching peer messages!')
+            self._close(e)
+
+    def eof_received(self):
+        logging.debug('Connection closed by peer')
+        return False
+
+    def connection_lost(self, exc):
+        if not self.closed.done():
+            if exc and not isinstance(exc, ConnectionResetError):
+                self.closed.set_exception(exc)
+            else:
+                self.closed.set_result(None)
+        if self._throttle is not None:
+            self._throttle.cancel()
+            self._throttle = None
+        self._wake_writer()
+
+    def pause_writing(self):
+        self._writing_paused = True
+        self.pause_reading()
+        if self._drain_waiter is None:
+            self._drain_waiter = \
+                asyncio.get_event_loop().create_future()
+
+    def resume_writing(self):
+        self._writing_paused = False
+        if self._throttle is None:
+            self.resume_reading()
+        self._wake_writer()
+
+    def throttle(self, delay: float):
+        """
+        Stop reading from the peer for `delay` seconds
+        """
+        if self._throttle is not None:
+            self._throttle.cancel()
+        self.pause_reading()
+        self._throttle = asyncio.get_event_loop().call_later(
+            delay, self._end_throttle)
+
+    def _end_throttle(self):
+        self._throttle = None
+        if not self._writing_paused:
+            self.resume_reading()
+
+    async def drain(self):
+        if self._drain_waiter is not None:
+            await self._drain_waiter
+
+    def _wake_writer(self):
+        waiter, self._drain_waiter = self._drain_waiter, None
+        if waiter is not None and not waiter.done():
+            waiter.set_result(None)
+
+    def pause_reading(self):
+        if not self._paused and not self.transport.is_closing():
+            self._paused = True
+            self.transport.pause_reading()
+
+    def resume_reading(self):
+        if self._paused and not self.transport.is_closing():
+            self._paused = False
+            self.transport.resume_reading()
+
+    def _on_handshake(self) -> bool:
+        data = self.buffer.read(Handshake.length)
+        if data is None:
+            return False
+        response = Handshake.decode(data)
+        if not response:
+            raise ProtocolError('Unable receive and parse a handshake')
+        if not response.info_hash == self.connection.info_hash:
+            raise ProtocolError('Handshake with invalid info_hash')
+        self._handshaken = True
+        self.connection._on_handshake(response.peer_id)
+        return True
+
+    def _close(self, exc):
+        if not self.closed.done():
+            self.closed.set_exception(exc)
+        self.transport.close()
+
+
+class RequestPipeline:
+    """
+    Keeps track of the block requests in flight to a single peer.
+
+    The window size is derived from the bandwidth-delay product of the
+    connection: the smoothed throughput times the lowest observed round-trip
+    time, with a gain of two so the window keeps growing until the link (and
+    not the window) becomes the bottleneck.
+    """
+    # Minimum time in seconds a throughput sample is measured over
+    SAMPLE_TIME = 0.5
+
+    def __init__(self):
+        # (piece index, block offset) -> time the request was sent
+        self.outstanding = OrderedDict()
+        self.depth = INITIAL_QUEUE_DEPTH
+        self.rate = 0.0  # Smoothed bytes per second
+        self.min_rtt = None
+        self._sample_start = None
+        self._sample_bytes = 0
+
+    def __len__(self):
+        return len(self.outstanding)
+
+    @property
+    def free(self) -> int:
+        return self.depth - len(self.outstanding)
+
+    def add(self, index: int, begin: int, length: int):
+        key = (index, begin)
+        self.outstanding.pop(key, None)
+        self.outstanding[key] = time.monotonic()
+
+    def received(self, index: int, begin: int, length: int):
+        now = time.monotonic()
+        sent = self.outstanding.pop((index, begin), None)
+        # Blocks we no longer wait for (e.g. expired) still count towards the
+        # throughput, they just do not give a latency sample.
+        if sent is not None:
+            if self.min_rtt is None or now - sent < self.min_rtt:
+                self.min_rtt = now - sent
+
+        if self._sample_start is None:
+            self._sample_start = now
+            self._sample_bytes = 0
+            return
+        self._sample_bytes += length
+        elapsed = now - self._sample_start
+        if elapsed >= max(self.SAMPLE_TIME, self.min_rtt or 0):
+            sample = self._sample_bytes / elapsed
+            self.rate = sample if not self.rate else \
+                0.75 * self.rate + 0.25 * sample
+            self._sample_start = now
+            self._sample_bytes = 0
+            self._resize()
+
+    def cancel(self, index: int, begin: int) -> bool:
+        return self.outstanding.pop((index, begin), None) is not None
+
+    def expire(self, timeout: float):
+        current = time.monotonic()
+        while self.outstanding:
+            key, sent = next(iter(self.outstanding.items()))
+            if sent + timeout >= current:
+                break
+            del self.outstanding[key]
+
+    def clear(self):
+        self.outstanding.clear()
+        # Throughput measured across a choke would be meaningless
+        self._sample_start = None
+
+    def _resize(self):
+        if not self.min_rtt:
+            return
+        bdp = self.rate * self.min_rtt / REQUEST_SIZE
+        self.depth = max(MIN_QUEUE_DEPTH,
+                         min(MAX_QUEUE_DEPTH, math.ceil(2 * bdp)))
+
+
 class PeerStreamIterator:
-    CHUNK_SIZE = 10*1024
+    CHUNK_SIZE = 64*1024
 
-    def __init__(self, reader, initial: bytes=None):
+    def __init__(self, reader, initial: bytes=None, max_length: int = None):
         self.reader = reader
-        self.buffer = initial if initial else b''
+        self.buffer = MessageBuffer(max_length=max_length)
+        if initial:
+            self.buffer.feed(initial)
 
-    async def __aiter__(self):
+    def __aiter__(self):
         return self
 
     async def __anext__(self):
         while True:
             try:
+                # Hand out every complete message already buffered before
+                # touching the socket again
+                message = self.buffer.next_message()
+                if message:
+                    return message
                 data = await self.reader.read(PeerStreamIterator.CHUNK_SIZE)
                 if data:
-                    self.buffer += data
-                    message = self.parse()
-                    if message:
-                        return message
+                    self.buffer.feed(data)
                 else:
                     logging.debug('No data read from stream')
-                    if self.buffer:
-                        message = self.parse()
-                        if message:
-                            return message
                     raise StopAsyncIteration()
             except ConnectionResetError:
                 logging.debug('Connection closed by peer')
@@ -190,63 +807,140 @@ class PeerStreamIterator:
                 raise StopAsyncIteration()
         raise StopAsyncIteration()
 
-    def parse(self):
 
+class MessageBuffer:
+    """
+    Reusable receive buffer framing the length-prefixed peer messages.
+
+    Received data is appended at a write cursor and messages are decoded in
+    place from a read cursor through memoryviews, so a message is never
+    copied out of the buffer before it is decoded. Space is reclaimed by
+    moving the unparsed tail, which is normally smaller than one message,
+    to the front of the buffer.
+    """
+    INITIAL_CAPACITY = 128*1024
+
+    def __init__(self, capacity: int = INITIAL_CAPACITY,
+                 max_length: int = None):
+        self._buffer = bytearray(capacity)
+        # Longer messages are refused before any room is made for them
+        self.max_length = max_length
+        self._start = 0  # Read cursor
+        self._end = 0    # Write cursor
+
+    def __len__(self):
+        return self._end - self._start
+
+    def feed(self, data: bytes):
+        length = len(data)
+        self._reserve(length)
+        self._buffer[self._end:self._end + length] = data
+        self._end += length
+
+    def next_message(self):
+        """
+        Decode and consume the next complete message in the buffer, or
+        return None if more data is needed.
+        """
         header_length = 4
 
-        if len(self.buffer) > 4:  # 4 bytes is needed to identify the message
-            message_length = struct.unpack('>I', self.buffer[0:4])[0]
-
+        while self._end - self._start >= header_length:
+            message_length = struct.unpack_from(
+                '>I', self._buffer, self._start)[0]
             if message_length == 0:
+                self._advance(header_length)
                 return KeepAlive()
-
-            if len(self.buffer) >= message_length:
-                message_id = struct.unpack('>b', self.buffer[4:5])[0]
-
-                def _consume():
-                    self.buffer = self.buffer[header_length + message_length:]
-
-                def _data():
-                    return self.buffer[:header_length + message_length]
-
-                if message_id is PeerMessage.BitField:
-                    data = _data()
-                    _consume()
-                    return BitField.decode(data)
-                elif message_id is PeerMessage.Interested:
-                    _consume()
-                    return Interested()
-                elif message_id is PeerMessage.NotInterested:
-                    _consume()
-                    return NotInterested()
-                elif message_id is PeerMessage.Choke:
-                    _consume()
-                    return Choke()
-                elif message_id is PeerMessage.Unchoke:
-                    _consume()
-                    return Unchoke()
-                elif message_id is PeerMessage.Have:
-                    data = _data()
-                    _consume()
-                    return Have.decode(data)
-                elif message_id is PeerMessage.Piece:
-                    data = _data()
-                    _consume()
-                    return Piece.decode(data)
-                elif message_id is PeerMessage.Request:
-                    data = _data()
-                    _consume()
-                    return Request.decode(data)
-                elif message_id is PeerMessage.Cancel:
-                    data = _data()
-                    _consume()
-                    return Cancel.decode(data)
-                else:
-                    logging.info('Unsupported message!')
-            else:
+            if self.max_length is not None and \
+                    message_length > self.max_length:
+                raise ProtocolError('Message of {length} bytes is too '
+                                    'long'.format(length=message_length))
+
+            total = header_length + message_length
+            if self._end - self._start < total:
+                # Make sure the whole message will fit once it arrives
+                self._reserve(total - (self._end - self._start))
                 logging.debug('Not enough in buffer in order to parse')
+                return None
+
+            with memoryview(self._buffer) as view:
+                data = view[self._start:self._start + total]
+                try:
+                    message = self._decode(data[4], data)
+                finally:
+                    data.release()
+            self._advance(total)
+            if message:
+                return message
+        return None
+
+    def _decode(self, message_id, data):
+        if message_id == PeerMessage.BitField:
+            return BitField.decode(data)
+        elif message_id == PeerMessage.Interested:
+            return Interested()
+        elif message_id == PeerMessage.NotInterested:
+            return NotInterested()
+        elif message_id == PeerMessage.Choke:
+            return Choke()
+        elif message_id == PeerMessage.Unchoke:
+            return Unchoke()
+        elif message_id == PeerMessage.Have:
+            return Have.decode(data)
+        elif message_id == PeerMessage.Piece:
+            return Piece.decode(data)
+        elif message_id == PeerMessage.Request:
+            return Request.decode(data)
+        elif message_id == PeerMessage.Cancel:
+            return Cancel.decode(data)
+        else:
+            logging.info('Unsupported message!')
         return None
 
+    def read(self, length: int):
+        """
+        Consume `length` raw bytes, or return None if not yet buffered
+        """
+        if self._end - self._start < length:
+            return None
+        data = bytes(self._buffer[self._start:self._start + length])
+        self._advance(length)
+        return data
+
+    def get_buffer(self, size_hint: int = -1):
+        """
+        Writable view over the free space after the write cursor, for
+        receiving directly into the buffer. Must be followed by a call to
+        `buffer_updated` with the number of bytes written.
+        """
+        self._reserve(max(size_hint, PeerStreamIterator.CHUNK_SIZE))
+        return memoryview(self._buffer)[self._end:]
+
+    def buffer_updated(self, length: int):
+        self._end += length
+
+    def _advance(self, length: int):
+        self._start += length
+        if self._start == self._end:
+            # Buffer drained, restart from the front without moving data
+            self._start = self._end = 0
+
+    def _reserve(self, length: int):
+        """
+        Make room for at least `length` bytes after the write cursor
+        """
+        capacity = len(self._buffer)
+        if capacity - self._end >= length:
+            return
+        pending = self._end - self._start
+        if pending + length <= capacity:
+            self._buffer[:pending] = self._buffer[self._start:self._end]
+        else:
+            grown = bytearray(max(2 * capacity, pending + length))
+            grown[:pending] = memoryview(self._buffer)[self._start:self._end]
+            self._buffer = grown
+        self._start = 0
+        self._end = pending
+
 
 class PeerMessage:
 
@@ -322,20 +1016,16 @@ class BitField(PeerMessage):
 
     def encode(self) -> bytes:
 
-        bits_length = len(self.bitfield)
-        return struct.pack('>Ib' + str(bits_length) + 's',
-                           1 + bits_length,
-                           PeerMessage.BitField,
-                           self.bitfield)
+        data = self.bitfield.tobytes()
+        return struct.pack('>Ib', 1 + len(data), PeerMessage.BitField) + data
 
     @classmethod
     def decode(cls, data: bytes):
-        message_length = struct.unpack('>I', data[:4])[0]
+        message_length = struct.unpack_from('>I', data)[0]
         logging.debug('Decoding BitField of length: {length}'.format(
             length=message_length))
 
-        parts = struct.unpack('>Ib' + str(message_length - 1) + 's', data)
-        return cls(parts[2])
+        return cls(bytes(data[5:4 + message_length]))
 
     def __str__(self):
         return 'BitField'
@@ -361,12 +1051,24 @@ class NotInterested(PeerMessage):
 
 class Choke(PeerMessage):
 
+    def encode(self) -> bytes:
+
+        return struct.pack('>Ib',
+                           1,  # Message length
+                           PeerMessage.Choke)
+
     def __str__(self):
         return 'Choke'
 
 
 class Unchoke(PeerMessage):
 
+    def encode(self) -> bytes:
+
+        return struct.pack('>Ib',
+                           1,  # Message length
+                           PeerMessage.Unchoke)
+
     def __str__(self):
         return 'Unchoke'
 
@@ -386,7 +1088,7 @@ class Have(PeerMessage):
     def decode(cls, data: bytes):
         logging.debug('Decoding Have of length: {length}'.format(
             length=len(data)))
-        index = struct.unpack('>IbI', data)[2]
+        index = struct.unpack_from('>IbI', data)[2]
         return cls(index)
 
     def __str__(self):
@@ -414,7 +1116,7 @@ class Request(PeerMessage):
         logging.debug('Decoding Request of length: {length}'.format(
             length=len(data)))
         # Tuple with (message length, id, index, begin, length)
-        parts = struct.unpack('>IbIII', data)
+        parts = struct.unpack_from('>IbIII', data)
         return cls(parts[2], parts[3], parts[4])
 
     def __str__(self):
@@ -431,6 +1133,14 @@ class Piece(PeerMessage):
         self.begin = begin
         self.block = block
 
+    @staticmethod
+    def header(index: int, begin: int, length: int) -> bytes:
+        """
+        The message up to the block, for writing the block separately
+        """
+        return struct.pack('>IbII', Piece.length + length, PeerMessage.Piece,
+                           index, begin)
+
     def encode(self):
         message_length = Piece.length + len(self.block)
         return struct.pack('>IbII' + str(len(self.block)) + 's',
@@ -444,10 +1154,9 @@ class Piece(PeerMessage):
     def decode(cls, data: bytes):
         logging.debug('Decoding Piece of length: {length}'.format(
             length=len(data)))
-        length = struct.unpack('>I', data[:4])[0]
-        parts = struct.unpack('>IbII' + str(length - Piece.length) + 's',
-                              data[:length+4])
-        return cls(parts[2], parts[3], parts[4])
+        # The block is the only copy made out of the receive buffer
+        length, _, index, begin = struct.unpack_from('>IbII', data)
+        return cls(index, begin, bytes(data[13:length + 4]))
 
     def __str__(self):
         return 'Piece'
@@ -473,7 +1182,7 @@ class Cancel(PeerMessage):
         logging.debug('Decoding Cancel of length: {length}'.format(
             length=len(data)))
         # Tuple with (message length, id, index, begin, length)
-        parts = struct.unpack('>IbIII', data)
+        parts = struct.unpack_from('>IbIII', data)
         return cls(parts[2], parts[3], parts[4])
 
     def __str__(self):
@@ -0,0 +1,556 @@
+import asyncio
+import bisect
+import contextlib
+import logging
+import mmap
+import os
+import threading
+from collections import deque, namedtuple, OrderedDict
+from hashlib import sha1
+
+import bencoding
+
+# Most buffers a single vectored write accepts
+IOV_MAX = os.sysconf('SC_IOV_MAX') if hasattr(os, 'sysconf') else 1024
+
+# When the written data is flushed to the disk
+FSYNC_NEVER = 'never'  # Leave it to the operating system
+FSYNC_BATCH = 'batch'  # After every batch of writes
+FSYNC_CLOSE = 'close'  # Once, when the writer is closed
+FSYNC_POLICIES = (FSYNC_NEVER, FSYNC_BATCH, FSYNC_CLOSE)
+
+# Default amount of queued data at which the writer reports congestion
+MAX_QUEUED_BYTES = 64 * 2**20
+
+# Default number of file descriptors kept open by a FileStorage
+MAX_OPEN_FILES = 64
+
+# Default amount of data kept in memory for uploading
+READ_CACHE_SIZE = 32 * 2**20
+
+# A queued write of `buffers` starting at file position `offset`
+WriteRequest = namedtuple('WriteRequest',
+                          ['offset', 'buffers', 'length', 'callback'])
+
+
+class FileStorage:
+    """
+    The torrent data as one contiguous range of bytes, stored in the
+    files of the torrent laid out one after another.
+
+    Reads and writes at a torrent offset are split into the segments of
+    the files they cover. At most `max_open_files` file descriptors are
+    kept open, the least recently used one is closed to make room. All
+    methods can be called from any thread.
+    """
+    def __init__(self, files: list, max_open_files: int = MAX_OPEN_FILES):
+        # (path, length) of every file, in torrent order
+        self.files = files
+        self.size = sum(length for _, length in files)
+        self._offsets = []
+        offset = 0
+        for _, length in files:
+            self._offsets.append(offset)
+            offset += length
+        self.max_open_files = max(1, max_open_files)
+        self._fds = OrderedDict()  # file index -> fd, least recent first
+        self._in_use = {}  # file index -> number of ongoing operations
+        self._dirty = set()  # Files written since the last sync
+        self._lock = threading.Lock()
+
+    def __str__(self):
+        if len(self.files) == 1:
+            return self.files[0][0]
+        return '{0} files'.format(len(self.files))
+
+    def segments(self, offset: int, length: int):
+        """
+        Yield the (file index, file offset, length) segments holding the
+        given range of the torrent data, skipping empty files.
+        """
+        index = bisect.bisect_right(self._offsets, offset) - 1
+        while length > 0 and index < len(self.files):
+            file_offset = offset - self._offsets[index]
+            size = min(length, self.files[index][1] - file_offset)
+            if size > 0:
+                yield index, file_offset, size
+                offset += size
+                length -= size
+            index += 1
+
+    def has_data(self) -> bool:
+        """
+        True if any of the files already holds some data
+        """
+        for path, _ in self.files:
+            try:
+                if os.path.getsize(path) > 0:
+                    return True
+            except OSError:
+                pass
+        return False
+
+    def create(self, preallocate: bool = False, skip=()):
+        """
+        Create the files of the torrent but the indices in `skip`,
+        optionally reserving their space
+        """
+        for index, (path, length) in enumerate(self.files):
+            if index in skip:
+                continue
+            fd = self._acquire(index)
+            try:
+                if preallocate and length:
+                    self._preallocate(fd, path, length)
+            finally:
+                self._release(index)
+
+    def read(self, offset: int, length: int) -> bytes:
+        """
+        Read the given range, shorter if the files do not hold all of it
+        """
+        buffer = bytearray(length)
+        with memoryview(buffer) as view:
+            position = 0
+            for index, file_offset, size in self.segments(offset, length):
+                fd = self._acquire(index)
+                try:
+                    read = self._preadv(fd, view[position:position + size],
+                                        file_offset)
+                finally:
+                    self._release(index)
+                position += read
+                if read < size:
+                    break
+        del buffer[position:]
+        return bytes(buffer)
+
+    def write(self, offset: int, buffers: list):
+        """
+        Write the buffers consecutively from the given torrent offset
+        """
+        buffers = [memoryview(b) for b in buffers]
+        for index, file_offset, size in self.segments(
+                offset, sum(len(b) for b in buffers)):
+            # Take the buffers, or parts of them, that fill this segment
+            segment = []
+            while size > 0:
+                buffer = buffers[0]
+                if len(buffer) <= size:
+                    segment.append(buffers.pop(0))
+                else:
+                    segment.append(buffer[:size])
+                    buffers[0] = buffer[size:]
+                size -= len(segment[-1])
+            fd = self._acquire(index)
+            try:
+                self._pwritev(fd, segment, file_offset)
+            finally:
+                self._release(index)
+            with self._lock:
+                self._dirty.add(index)
+
+    @contextlib.contextmanager
+    def open_file(self, index: int):
+        """
+        A binary file object of the given file, its descriptor stays open
+        until the block is left. The file position is not used by the
+        storage, so it may be moved freely.
+        """
+        fd = self._acquire(index)
+        try:
+            with os.fdopen(fd, 'rb', buffering=0, closefd=False) as file:
+                yield file
+        finally:
+            self._release(index)
+
+    def sync(self):
+        """
+        Flush the files written since the last sync to the disk
+        """
+        with self._lock:
+            dirty, self._dirty = self._dirty, set()
+        for index in dirty:
+            # fsync flushes the file, it does not matter through which fd
+            fd = self._acquire(index)
+            try:
+                os.fsync(fd)
+            finally:
+                self._release(index)
+
+    def close(self):
+        with self._lock:
+            for fd in self._fds.values():
+                os.close(fd)
+            self._fds.clear()
+
+    def _acquire(self, index: int) -> int:
+        with self._lock:
+            fd = self._fds.get(index)
+            if fd is None:
+                path = self.files[index][0]
+                directory = os.path.dirname(path)
+                if directory:
+                    os.makedirs(directory, exist_ok=True)
+                fd = os.open(path, os.O_RDWR | os.O_CREAT)
+                self._fds[index] = fd
+                self._evict()
+            else:
+                self._fds.move_to_end(index)
+            self._in_use[index] = self._in_use.get(index, 0) + 1
+            return fd
+
+    def _release(self, index: int):
+        with self._lock:
+            self._in_use[index] -= 1
+            if not self._in_use[index]:
+                del self._in_use[index]
+            self._evict()
+
+    def _evict(self):
+        # Files in use by another thread stay open, the pool can be over
+        # its size for a moment
+        for index in list(self._fds):
+            if len(self._fds) <= self.max_open_files:
+                break
+            if index not in self._in_use:
+                os.close(self._fds.pop(index))
+
+    @staticmethod
+    def _preallocate(fd: int, path: str, size: int):
+        try:
+            if hasattr(os, 'posix_fallocate'):
+                os.posix_fallocate(fd, 0, size)
+            else:
+                os.ftruncate(fd, size)
+        except OSError as e:
+            # Not supported by every filesystem, writes still work without
+            logging.warning('Unable to preallocate {path}: {error}'.format(
+                path=path, error=e))
+
+    @staticmethod
+    def _preadv(fd: int, view, offset: int) -> int:
+        read = 0
+        while read < len(view):
+            if hasattr(os, 'preadv'):
+                count = os.preadv(fd, [view[read:]], offset + read)
+            else:
+                data = os.pread(fd, len(view) - read, offset + read)
+                count = len(data)
+                view[read:read + count] = data
+            if not count:
+                break
+            read += count
+        return read
+
+    @staticmethod
+    def _pwritev(fd: int, buffers: list, offset: int):
+        if not hasattr(os, 'pwritev'):
+            for buffer in buffers:
+                view = buffer
+                while view:
+                    written = os.pwrite(fd, view, offset)
+                    offset += written
+                    view = view[written:]
+            return
+        first = 0
+        while first < len(buffers):
+            written = os.pwritev(fd, buffers[first:first + IOV_MAX], offset)
+            offset += written
+            # Short writes are allowed, continue after the last byte written
+            while first < len(buffers) and written >= len(buffers[first]):
+                written -= len(buffers[first])
+                first += 1
+            if written:
+                buffers[first] = buffers[first][written:]
+
+
+class DiskWriter:
+    """
+    Writes data to the files of a FileStorage from a dedicated worker
+    thread, so a slow disk never stalls the event loop.
+
+    Writes are queued by the event loop and picked up by the worker in
+    batches. Within a batch, writes to adjacent regions are merged into a
+    single positional vectored write per file. The completion callback of
+    every write is called on the event loop with None, or the OSError
+    raised while writing.
+    """
+    def __init__(self, storage: FileStorage, fsync: str = FSYNC_NEVER,
+                 max_queued_bytes: int = MAX_QUEUED_BYTES):
+        if fsync not in FSYNC_POLICIES:
+            raise ValueError('Unknown fsync policy {0}'.format(fsync))
+        self.storage = storage
+        self.fsync = fsync
+        self.max_queued_bytes = max_queued_bytes
+        self.queued_bytes = 0
+
+        self._loop = None
+        self._queue = deque()
+        self._condition = threading.Condition()
+        self._closing = False
+        self._thread = threading.Thread(target=self._run, daemon=True,
+                                        name='DiskWriter')
+        self._thread.start()
+
+    @property
+    def congested(self) -> bool:
+        return self.queued_bytes >= self.max_queued_bytes
+
+    def write(self, offset: int, buffers: list, callback=None):
+        """
+        Queue the given buffers to be written consecutively from the torrent
+        offset `offset`.
+        """
+        if self._loop is None:
+            self._loop = asyncio.get_event_loop()
+        length = sum(len(b) for b in buffers)
+        with self._condition:
+            if self._closing:
+                raise RuntimeError('Writing to a closed DiskWriter')
+            self.queued_bytes += length
+            self._queue.append(WriteRequest(offset, buffers, length, callback))
+            self._condition.notify()
+
+    def read(self, offset: int, length: int) -> bytes:
+        """
+        Read data that has already been written, blocking the caller
+        """
+        return self.storage.read(offset, length)
+
+    def close(self):
+        """
+        Wait for all queued writes to finish and close the files
+        """
+        with self._condition:
+            if self._closing:
+                return
+            self._closing = True
+            self._condition.notify()
+        self._thread.join()
+        if self.fsync != FSYNC_NEVER:
+            self.storage.sync()
+        self.storage.close()
+
+    def _run(self):
+        while True:
+            with self._condition:
+                while not self._queue and not self._closing:
+                    self._condition.wait()
+                if not self._queue:
+                    return
+                batch = list(self._queue)
+                self._queue.clear()
+
+            batch.sort(key=lambda r: r.offset)
+            for run in self._coalesce(batch):
+                error = None
+                try:
+                    self.storage.write(run[0].offset,
+                                       [b for r in run for b in r.buffers])
+                except OSError as e:
+                    logging.error('Unable to write to {path}: {error}'.format(
+                        path=self.storage, error=e))
+                    error = e
+                self._done(run, error)
+            if self.fsync == FSYNC_BATCH:
+                self.storage.sync()
+
+    @staticmethod
+    def _coalesce(batch):
+        """
+        Group sorted write requests into runs covering adjacent regions
+        """
+        run = [batch[0]]
+        for request in batch[1:]:
+            previous = run[-1]
+            if previous.offset + previous.length == request.offset:
+                run.append(request)
+            else:
+                yield run
+                run = [request]
+        yield run
+
+    def _done(self, run, error):
+        with self._condition:
+            self.queued_bytes -= sum(r.length for r in run)
+        for request in run:
+            if request.callback:
+                try:
+                    self._loop.call_soon_threadsafe(request.callback, error)
+                except RuntimeError:
+                    # The event loop is already closed, nobody is waiting
+                    pass
+
+
+class BufferPool:
+    """
+    Recycles the fixed-size buffers pieces are assembled in, and puts a
+    hard cap on the memory held by them.
+
+    At most `max_bytes` worth of buffers is ever allocated, whether in use
+    or kept around for reuse. Once that is reached `exhausted` is True
+    until a buffer is released.
+    """
+    def __init__(self, buffer_size: int, max_bytes: int):
+        self.buffer_size = buffer_size
+        # Allow at least one buffer, or nothing could ever be downloaded
+        self.max_buffers = max(1, max_bytes // buffer_size)
+        self.in_use = 0
+        self._free = []
+
+    @property
+    def exhausted(self) -> bool:
+        return self.in_use >= self.max_buffers
+
+    @property
+    def allocated_bytes(self) -> int:
+        return (self.in_use + len(self._free)) * self.buffer_size
+
+    def acquire(self) -> bytearray:
+        if self.exhausted:
+            raise MemoryError('Staging memory limit reached')
+        self.in_use += 1
+        if self._free:
+            return self._free.pop()
+        return bytearray(self.buffer_size)
+
+    def release(self, buffer: bytearray):
+        self.in_use -= 1
+        self._free.append(buffer)
+
+
+class ReadCache:
+    """
+    LRU cache of the data read from a FileStorage to be uploaded, kept
+    per piece. A miss reads from the requested block up to the end of its
+    piece, as peers mostly go on to request the blocks after it. Reads
+    run in the default executor, concurrent misses on the same piece
+    share a single read.
+    """
+    def __init__(self, storage: FileStorage, piece_length: int,
+                 max_bytes: int = READ_CACHE_SIZE):
+        self.storage = storage
+        self.piece_length = piece_length
+        self.max_bytes = max_bytes
+        self.size = 0
+        # piece index -> (offset within the piece, data), least recent first
+        self._entries = OrderedDict()
+        self._reads = {}  # piece index -> future of an ongoing read
+
+    async def read(self, index: int, begin: int, length: int,
+                   piece_size: int) -> bytes:
+        while True:
+            entry = self._entries.get(index)
+            if entry and entry[0] <= begin and \
+                    begin + length <= entry[0] + len(entry[1]):
+                self._entries.move_to_end(index)
+                start = begin - entry[0]
+                return entry[1][start:start + length]
+            read = self._reads.get(index)
+            if read is None:
+                break
+            await asyncio.shield(read)
+
+        loop = asyncio.get_event_loop()
+        read = loop.run_in_executor(
+            None, self.storage.read, index * self.piece_length + begin,
+            piece_size - begin)
+        self._reads[index] = read
+        try:
+            data = await asyncio.shield(read)
+        finally:
+            del self._reads[index]
+        self._store(index, begin, data)
+        return data[:length]
+
+    def _store(self, index: int, begin: int, data: bytes):
+        previous = self._entries.pop(index, None)
+        if previous:
+            self.size -= len(previous[1])
+        self._entries[index] = (begin, data)
+        self.size += len(data)
+        while self.size > self.max_bytes and self._entries:
+            _, (_, evicted) = self._entries.popitem(last=False)
+            self.size -= len(evicted)
+
+
+def read_resume(path: str, info_hash: bytes):
+    """
+    Read the fast-resume state stored at `path`, returning None if there is
+    none or it does not belong to the torrent with the given info hash.
+    """
+    try:
+        with open(path, 'rb') as f:
+            state = bencoding.Decoder(f.read()).decode()
+    except FileNotFoundError:
+        return None
+    except Exception as e:
+        logging.warning('Ignoring unreadable resume file {path}: {error}'
+                        .format(path=path, error=e))
+        return None
+    if not isinstance(state, dict) or state.get(b'info_hash') != info_hash:
+        logging.warning('Ignoring resume file {path} of another torrent'
+                        .format(path=path))
+        return None
+    return state
+
+
+def write_resume(path: str, state: dict):
+    """
+    Atomically replace the fast-resume state stored at `path`
+    """
+    temporary = path + '.tmp'
+    with open(temporary, 'wb') as f:
+        bencoding.Encoder(state).encode_to(f)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(temporary, path)
+
+
+def hash_pieces(files: list, piece_length: int, first: int, last: int):
+    """
+    Return the SHA-1 digests of the pieces `first` up to (not including)
+    `last` as found in the given (path, length) files, or None for pieces
+    the files are too short to hold. Files are read through memory maps,
+    so this can run in any number of processes in parallel.
+    """
+    storage = FileStorage(files)
+    mapped = {}  # file index -> mmap, None if there is nothing to map
+
+    def view(index):
+        if index not in mapped:
+            mapped[index] = None
+            try:
+                with open(files[index][0], 'rb') as f:
+                    if os.fstat(f.fileno()).st_size:
+                        mapped[index] = mmap.mmap(f.fileno(), 0,
+                                                  access=mmap.ACCESS_READ)
+            except OSError:
+                pass
+        return mapped[index]
+
+    digests = []
+    try:
+        for index in range(first, last):
+            start = index * piece_length
+            hasher = sha1()
+            for file_index, offset, size in storage.segments(
+                    start, min(piece_length, storage.size - start)):
+                # Pieces are hashed in order, earlier files are done
+                for done in [i for i in mapped if i < file_index]:
+                    if mapped[done] is not None:
+                        mapped[done].close()
+                    del mapped[done]
+                data = view(file_index)
+                if data is None or len(data) < offset + size:
+                    hasher = None
+                    break
+                with memoryview(data) as memory:
+                    hasher.update(memory[offset:offset + size])
+            digests.append(hasher.digest() if hasher else None)
+    finally:
+        for data in mapped.values():
+            if data is not None:
+                data.close()
+    return digests
@@ -1,9 +1,44 @@
+import os
 from hashlib import sha1
 from collections import namedtuple
 
 import bencoding
 
-TorrentFile = namedtuple('TorrentFile', ['name', 'length'])
+# A file of the torrent, starting `offset` bytes into the torrent data
+TorrentFile = namedtuple('TorrentFile', ['name', 'length', 'offset'])
+
+# Length of a SHA-1 digest in the pieces string
+HASH_LENGTH = 20
+
+
+class PieceHashes:
+    """
+    Immutable table of the SHA-1 hash of every piece, indexed by piece
+    number. It is a view over the raw `pieces` string of the torrent, so
+    no per-piece objects are created until a hash is looked up.
+    """
+    __slots__ = ('_view',)
+
+    def __init__(self, data: bytes):
+        if len(data) % HASH_LENGTH:
+            raise RuntimeError('Invalid length of the pieces hashes')
+        self._view = memoryview(data).toreadonly()
+
+    def __len__(self):
+        return len(self._view) // HASH_LENGTH
+
+    def __getitem__(self, index: int) -> bytes:
+        if index < 0:
+            index += len(self)
+        if not 0 <= index < len(self):
+            raise IndexError('Piece index out of range')
+        start = index * HASH_LENGTH
+        return self._view[start:start + HASH_LENGTH].tobytes()
+
+    def __iter__(self):
+        view = self._view
+        for start in range(0, len(view), HASH_LENGTH):
+            yield view[start:start + HASH_LENGTH].tobytes()
 
 
 class Torrent:  # 解析种子文件
@@ -13,18 +48,39 @@ class Torrent:  # 解析种子文件
 
         with open(self.filename, 'rb') as f:
             meta_info = f.read()
-            self.meta_info = bencoding.Decoder(meta_info).decode()
-            info = bencoding.Encoder(self.meta_info[b'info']).encode()
-            self.info_hash = sha1(info).digest()
-            self._identify_files()
-
-        if self.multi_file:
-            # TODO Add support for multi-file torrents
-            raise RuntimeError('Multi-file torrents is not supported!')
-        self.files.append(
-            TorrentFile(
-                self.meta_info[b'info'][b'name'].decode('utf-8'),
-                self.meta_info[b'info'][b'length']))
+        decoder = bencoding.Decoder(meta_info)
+        self.meta_info = decoder.decode()
+        if decoder.info_span is None:
+            raise RuntimeError('Torrent has no info dictionary')
+        # Hash the info dict exactly as found in the file, encoding the
+        # decoded dict again would change it if its keys were not sorted
+        start, end = decoder.info_span
+        self.info_hash = sha1(memoryview(meta_info)[start:end]).digest()
+        self._identify_files()
+
+        # Parsed once, the lengths of all pieces follow from the last one
+        self.pieces = PieceHashes(self.meta_info[b'info'][b'pieces'])
+        self.last_piece_length = \
+            self.total_size - (len(self.pieces) - 1) * self.piece_length
+
+    def _identify_files(self):
+        info = self.meta_info[b'info']
+        if not self.multi_file:
+            self.files.append(
+                TorrentFile(self.output_file, info[b'length'], 0))
+            return
+
+        # The files are laid out one after another in the order listed,
+        # inside a directory named after the torrent
+        offset = 0
+        for entry in info[b'files']:
+            path = [_path_component(part) for part in entry[b'path']]
+            if not path:
+                raise RuntimeError('Torrent file without a path')
+            self.files.append(TorrentFile(
+                os.path.join(self.output_file, *path), entry[b'length'],
+                offset))
+            offset += entry[b'length']
 
     @property
     def announce(self) -> str:
@@ -45,32 +101,33 @@ class Torrent:  # 解析种子文件
     @property
     def total_size(self) -> int:
 
-        if self.multi_file:
-            raise RuntimeError('Multi-file torrents is not supported!')
-        return self.files[0].length
-
-    @property
-    def pieces(self):
+        return sum(file.length for file in self.files)
 
-        data = self.meta_info[b'info'][b'pieces']
-        pieces = []
-        offset = 0
-        length = len(data)
+    def piece_size(self, index: int) -> int:
 
-        while offset < length:
-            pieces.append(data[offset:offset + 20])
-            offset += 20
-        return pieces
+        if index == len(self.pieces) - 1:
+            return self.last_piece_length
+        return self.piece_length
 
     @property
     def output_file(self):
-        return self.meta_info[b'info'][b'name'].decode('utf-8')
+        # The file itself, or the directory holding all the files
+        return _path_component(self.meta_info[b'info'][b'name'])
 
     def __str__(self):
         return 'Filename: {0}\n' \
                'File length: {1}\n' \
                'Announce URL: {2}\n' \
                'Hash: {3}'.format(self.meta_info[b'info'][b'name'],
-                                  self.meta_info[b'info'][b'length'],
+                                  self.total_size,
                                   self.meta_info[b'announce'],
                                   self.info_hash)
+
+
+def _path_component(name: bytes) -> str:
+    # Names come from the torrent, never let them point outside the
+    # download directory
+    name = name.decode('utf-8')
+    if name in ('', '.', '..') or '/' in name or os.sep in name:
+        raise RuntimeError('Invalid file name {0!r} in torrent'.format(name))
+    return name
@@ -7,6 +7,9 @@ from urllib.parse import urlencode
 
 import bencoding
 
+# Default port we accept connections from other peers on
+LISTEN_PORT = 6889
+
 
 class TrackerResponse:
 
@@ -65,23 +68,27 @@ class TrackerResponse:
 
 class Tracker:
 
-    def __init__(self, torrent):
+    def __init__(self, torrent, port: int = LISTEN_PORT):
         self.torrent = torrent
+        # The port announced for other peers to connect to
+        self.port = port
         self.peer_id = _calculate_peer_id()
         self.http_client = aiohttp.ClientSession()
 
     async def connect(self,
                       first: bool = None,
                       uploaded: int = 0,
-                      downloaded: int = 0):
+                      downloaded: int = 0,
+                      left: int = None):
 
         params = {
             'info_hash': self.torrent.info_hash,
             'peer_id': self.peer_id,
-            'port': 6889,
+            'port': self.port,
             'uploaded': uploaded,
             'downloaded': downloaded,
-            'left': self.torrent.total_size - downloaded,
+            'left': self.torrent.total_size - downloaded
+            if left is None else left,
             'compact': 1}
         if first:
             params['event'] = 'started'
@@ -118,7 +125,7 @@ class Tracker:
         return {
             'info_hash': self.torrent.info_hash,
             'peer_id': self.peer_id,
-            'port': 6889,
+            'port': self.port,
             # TODO Update stats when communicating with tracker
             'uploaded': 0,
             'downloaded': 0,